@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+
+# MIT License
+
+# Copyright 2018 BorisFX, Inc
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and
+# associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT
+# LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks for build-binary-artifact.py's hashing, walking and packing.
+
+Generates synthetic source trees (many tiny files, a few huge ones, deep
+nesting, and a mix of compressible and incompressible data), then times
+hash_dir_contents, make_zipfile, make_tarfile and validate_archive on
+each, separately, in-process. Prints MB/s and files/s for each. Also
+times how long a --hash-only run of the command takes to start up, as
+a script and through binary_artifact.py, against plain `python -c pass`.
+It can save the results as JSON and compare them with an earlier run's, e.g.:
+
+    python bench_binary_artifact.py --json before.json
+    (change things)
+    python bench_binary_artifact.py --json after.json --compare before.json
+
+--scale shrinks or grows every tree (the defaults total about 700 MB).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os, sys
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import binary_artifact
+
+# name: (number of files, file size, dir depth, fraction of incompressible files)
+TREES = {
+    'tiny':  (20000, 1024, 2, 0.5),
+    'huge':  (4, 128 << 20, 1, 0.5),
+    'deep':  (2000, 16 << 10, 40, 0.5),
+    'mixed': (2000, 64 << 10, 3, 0.5),
+}
+OPERATIONS = ('hash', 'zip', 'tar', 'validate')
+WORDS = b'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor'.split()
+
+def make_tree(root, nfiles, size, depth, random_fraction, seed=0):
+    """Write nfiles files of size bytes under root, spread over dirs nested
+    up to depth deep; random_fraction of them are random bytes, the rest
+    compressible text. The same arguments always make the same tree."""
+    rng = random.Random(seed)
+    text = b' '.join(rng.choice(WORDS) for i in range(size // 4 + 1))[:size]
+    for i in range(nfiles):
+        parts = ['d%d' % ((i >> (3 * level)) % 8) for level in range(rng.randint(0, depth - 1))]
+        dir = os.path.join(root, *parts)
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, 'f%06d.dat' % i), 'wb') as f:
+            if rng.random() < random_fraction:
+                f.write(rng.randbytes(size))
+            else:
+                f.write(text)
+    return nfiles, nfiles * size
+
+def time_operation(operation, tree, workdir, args):
+    """Run one operation on the tree in tree (a dir) and return its wall time
+    in seconds. The zip for validate is made beforehand, untimed."""
+    config = binary_artifact.ArtifactBuilder(
+        silent=True, no_hash_cache=True, outdir=workdir, jobs=args.jobs, build_id='1', build_branch='bench',
+        hash_scheme=args.hash_scheme).config(dir=['.'], name='bench', base_version='1.0')
+    orig_cwd = os.getcwd()
+    os.chdir(tree)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            if operation == 'validate':
+                path = binary_artifact.make_zipfile(['.'], 'bench-manifest.txt', workdir, config)[0]
+                config.dir = [path]
+            start = time.perf_counter()
+            if operation == 'hash':
+                binary_artifact.hash_dir_contents(['.'], '*-manifest.txt', config)
+            elif operation == 'zip':
+                path = binary_artifact.make_zipfile(['.'], 'bench-manifest.txt', workdir, config)[0]
+            elif operation == 'tar':
+                path = binary_artifact.make_tarfile(['.'], 'bench-manifest.txt', workdir, config)[0]
+            else:
+                binary_artifact.validate_archive(config)
+            seconds = time.perf_counter() - start
+    finally:
+        os.chdir(orig_cwd)
+    if operation != 'hash':
+        os.unlink(path)
+    return seconds
+
+def time_startup(tree, runs):
+    """Return the mean seconds per run of a plain python startup, and of a
+    --hash-only run on the (small) tree through each entry point."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        'python': ['-c', 'pass'],
+        'script': [os.path.join(here, 'build-binary-artifact.py')],
+        'module': [os.path.join(here, 'binary_artifact.py')],
+    }
+    times = {}
+    for name, command in commands.items():
+        if name != 'python':
+            command = command + ['--name', 'bench', '-B', '1.0', '--build-id', '1', '--hash-only', tree]
+        subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, check=True) # warm up
+        start = time.perf_counter()
+        for i in range(runs):
+            subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, check=True)
+        times[name] = (time.perf_counter() - start) / runs
+    return times
+
+def git_commit():
+    """The current commit of this checkout, if it's a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, old, threshold):
+    """Print how each result compares with the old run's; return the number
+    of regressions (more than threshold slower)."""
+    regressions = 0
+    print("\n%-16s %10s %10s %8s" % ('vs. ' + (old.get('commit') or 'old')[:12], 'old s', 'new s', 'ratio'))
+    for key, result in results.items():
+        if key not in old['results']:
+            continue
+        ratio = result['seconds'] / old['results'][key]['seconds'] if old['results'][key]['seconds'] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print("%-16s %10.3f %10.3f %8.2f%s" % (key, old['results'][key]['seconds'], result['seconds'], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="""Multiply the number of files (or size, for huge) in each tree by this.""")
+    parser.add_argument('--trees', nargs='+', choices=sorted(TREES), default=sorted(TREES),
+                        help="""Which trees to benchmark.""")
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS),
+                        help="""Which operations to time.""")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="""Time each operation this many times and keep the best.""")
+    parser.add_argument('--hash-scheme', default='legacy',
+                        help="""Hash scheme to build with (as for build-binary-artifact.py).""")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help="""Worker threads (as for build-binary-artifact.py).""")
+    parser.add_argument('--startup-runs', type=int, default=20,
+                        help="""Time this many --hash-only runs of each entry point for the startup\n"""
+                        """benchmark (0 to skip it).""")
+    parser.add_argument('--dir',
+                        help="""Make the trees here (default: a temp dir, deleted afterwards).""")
+    parser.add_argument('--json',
+                        help="""Save the results to this JSON file.""")
+    parser.add_argument('--compare', metavar='JSON',
+                        help="""Compare with the results of an earlier run, saved with --json.""")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="""With --compare, report operations more than this fraction slower as\n"""
+                        """regressions, and exit with status 1 if there are any.""")
+    args = parser.parse_args(argv)
+
+    workdir = args.dir or tempfile.mkdtemp(prefix='bench-binary-artifact-')
+    results = {}
+    try:
+        print("%-16s %10s %10s %12s" % ('benchmark', 'seconds', 'MB/s', 'files/s'))
+        for name in args.trees:
+            nfiles, size, depth, random_fraction = TREES[name]
+            if name == 'huge':
+                size = max(1, int(size * args.scale))
+            else:
+                nfiles = max(1, int(nfiles * args.scale))
+            tree = os.path.join(workdir, name)
+            shutil.rmtree(tree, ignore_errors=True)
+            nfiles, nbytes = make_tree(tree, nfiles, size, depth, random_fraction)
+            for operation in args.operations:
+                seconds = min(time_operation(operation, tree, workdir, args) for i in range(args.repeat))
+                key = '%s/%s' % (name, operation)
+                results[key] = {'seconds': seconds, 'files': nfiles, 'bytes': nbytes,
+                                'mb_per_s': nbytes / 1e6 / seconds, 'files_per_s': nfiles / seconds}
+                print("%-16s %10.3f %10.1f %12.0f" % (key, seconds, results[key]['mb_per_s'],
+                                                      results[key]['files_per_s']))
+        if args.startup_runs:
+            tree = os.path.join(workdir, 'startup')
+            shutil.rmtree(tree, ignore_errors=True)
+            make_tree(tree, 10, 1024, 1, 0.5)
+            for name, seconds in time_startup(tree, args.startup_runs).items():
+                key = 'startup/%s' % name
+                results[key] = {'seconds': seconds, 'runs': args.startup_runs}
+                print("%-16s %10.3f" % (key, seconds))
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    run = {'commit': git_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+           'cpus': os.cpu_count(), 'scale': args.scale, 'hash_scheme': args.hash_scheme,
+           'jobs': args.jobs, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare_results(results, json.load(f), args.threshold):
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
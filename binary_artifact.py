@@ -0,0 +1,47 @@
+# MIT License
+
+# Copyright 2018 BorisFX, Inc
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and
+# associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT
+# LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Importable name for build-binary-artifact.py, whose file name isn't a
+valid module name. The script stays a single self-contained file; this
+loads it as the binary_artifact module, e.g.:
+
+    import binary_artifact
+    builder = binary_artifact.ArtifactBuilder(outdir='dist')
+    builder.build(['bin'], 'foo', '1.0')
+
+It also runs as the command itself, with the same arguments. That starts
+faster than running build-binary-artifact.py, since imported code is
+compiled once and cached, while a script is compiled on every run:
+
+    python binary_artifact.py --name foo -B 1.0 --hash-only bin
+"""
+
+import importlib.util
+import os, sys
+
+_name = 'binary_artifact' if __name__ == '__main__' else __name__
+_spec = importlib.util.spec_from_file_location(
+    _name, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build-binary-artifact.py'))
+_module = importlib.util.module_from_spec(_spec)
+sys.modules[_name] = _module
+_spec.loader.exec_module(_module)
+
+if __name__ == '__main__':
+    sys.exit(_module.main(sys.argv[1:]))
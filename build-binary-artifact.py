@@ -20,18 +20,164 @@
 
 import argparse
 import sys, os
+import posixpath
 import string
-import socket                   # for machine name
-import getpass                  # for getuser
-import platform
 import fnmatch, glob
-import tempfile
-import time, datetime
-import subprocess
-import tarfile, zipfile
+import re
+import time
+import hashlib
+import struct
+import stat
+import io
+import collections
+import contextlib
+import functools
+import heapq
+import bisect
+import threading
+import zlib
+import mmap
 
-import logging
-logging.basicConfig(format='%(message)s')
+class LazyModule:
+    """Stands in for a module until it's first used, then imports it (and
+    calls setup(module), if given) and replaces itself with it in this
+    module's globals, so that modes which don't need a module (like
+    --hash-only and tarfile) don't pay to import it."""
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+
+    def __getattr__(self, attr):
+        module = __import__(self._name) # the top-level package, e.g. concurrent
+        if self._setup is not None:
+            self._setup(module)
+        globals()[self._name.split('.')[0]] = module
+        return getattr(module, attr)
+
+logging = LazyModule('logging', setup=lambda logging: logging.basicConfig(format='%(message)s'))
+datetime = LazyModule('datetime')
+
+socket = LazyModule('socket')           # for machine name
+getpass = LazyModule('getpass')         # for getuser
+platform = LazyModule('platform')
+tempfile = LazyModule('tempfile')
+subprocess = LazyModule('subprocess')
+tarfile = LazyModule('tarfile')
+zipfile = LazyModule('zipfile')
+shutil = LazyModule('shutil')
+concurrent = LazyModule('concurrent.futures')
+json = LazyModule('json')
+
+HASH_LEN = 16                   # hex digits of content hash in artifact names
+ZIP_LOCAL_HEADER_SIZE = 30      # fixed part of a zip local file header, before the filename
+ZIP_CHUNK_SIZE = 1 << 20        # zip entries are deflated in independent chunks of this size
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08 # general purpose flag: CRC and sizes follow the data
+ZIP_DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+
+def info_stream(args):
+    """Where to print the manifest and progress info: stdout, unless the
+    artifact itself is being written there."""
+    if getattr(args, 'output', None) == '-':
+        return sys.stderr
+    return sys.stdout
+
+class PhaseStats:
+    """Timings and counts for --stats: wall and CPU time per phase (excluding
+    the phases nested inside it), files and bytes read, bytes written, and
+    the top slowest files. CPU time is the whole process's, so it includes
+    worker threads and can exceed the wall time."""
+    def __init__(self, top=10):
+        self.start = (time.perf_counter(), time.process_time())
+        self.phases = collections.OrderedDict() # name: [wall, cpu, calls]
+        self.stack = []
+        self.top = top
+        self.slowest = []       # heap of (seconds, path, size)
+        self.files = self.bytes_read = self.bytes_written = 0
+        self.compress_seconds = 0.0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = (time.perf_counter(), time.process_time())
+        self.stack.append([0.0, 0.0])   # time spent in nested phases
+        try:
+            yield
+        finally:
+            nested = self.stack.pop()
+            wall, cpu = time.perf_counter() - start[0], time.process_time() - start[1]
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall - nested[0]
+            totals[1] += cpu - nested[1]
+            totals[2] += 1
+            if self.stack:
+                self.stack[-1][0] += wall
+                self.stack[-1][1] += cpu
+
+    def add_file(self, path, size, seconds):
+        """Count a source file read in full, which took seconds."""
+        with self.lock:
+            self.files += 1
+            self.bytes_read += size
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, (seconds, path, size))
+            elif self.top:
+                heapq.heappushpop(self.slowest, (seconds, path, size))
+
+    def result(self):
+        """Return the stats as a dict (as written to the --stats JSON file)."""
+        wall, cpu = time.perf_counter() - self.start[0], time.process_time() - self.start[1]
+        phases = {name: {'wall': w, 'cpu': c, 'calls': n} for name, (w, c, n) in self.phases.items()}
+        phases['other'] = {'wall': wall - sum(p['wall'] for p in phases.values()),
+                           'cpu': cpu - sum(p['cpu'] for p in phases.values()), 'calls': 1}
+        return {'wall': wall, 'cpu': cpu, 'phases': phases,
+                'files': self.files, 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'compression_ratio': self.bytes_written / self.bytes_read if self.bytes_read else None,
+                'zip_compress_thread_seconds': self.compress_seconds,
+                'slowest_files': [{'path': path, 'size': size, 'seconds': seconds}
+                                  for seconds, path, size in sorted(self.slowest, reverse=True)]}
+
+    def report(self, dest=None):
+        """Write the stats as JSON to the file dest, or as a table to stderr if dest is None."""
+        result = self.result()
+        if dest is not None:
+            with open(dest, 'w') as f:
+                json.dump(result, f, indent=1)
+            return
+        out = sys.stderr
+        out.write("%-10s %10s %10s %8s\n" % ('phase', 'wall s', 'cpu s', 'calls'))
+        for name, phase in result['phases'].items():
+            out.write("%-10s %10.3f %10.3f %8d\n" % (name, phase['wall'], phase['cpu'], phase['calls']))
+        out.write("%-10s %10.3f %10.3f\n" % ('total', result['wall'], result['cpu']))
+        out.write("Files read: %d, %d bytes; wrote %d bytes" % (
+            result['files'], result['bytes_read'], result['bytes_written']))
+        if result['compression_ratio'] is not None and result['bytes_written']:
+            out.write(" (ratio %.3f)" % result['compression_ratio'])
+        out.write("\n")
+        if result['zip_compress_thread_seconds']:
+            out.write("Zip compression: %.3f thread-seconds\n" % result['zip_compress_thread_seconds'])
+        if result['slowest_files']:
+            out.write("Slowest files:\n")
+            for file in result['slowest_files']:
+                out.write("%10.3f s %14d %s\n" % (file['seconds'], file['size'], file['path']))
+
+stats = None                    # the PhaseStats, while --stats is on
+
+def stats_phase(name):
+    """Context manager timing a block as the named --stats phase (a no-op when it's off)."""
+    return stats.phase(name) if stats is not None else contextlib.nullcontext()
+
+def timed_phase(name):
+    """Decorator that times calls to a function as the named --stats phase.
+    When --stats is off it's just one extra check per call."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if stats is None:
+                return func(*args, **kwargs)
+            with stats.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
 
 def write_manifest(name, args, extra):
     """Write a manifest file from the args."""
@@ -52,93 +198,568 @@ def write_manifest(name, args, extra):
             line = "%s: %s\n" % (k, getattr(args, arg_key))
             f.write(line)
             if not args.silent:
-                sys.stdout.write(line)
+                info_stream(args).write(line)
         if extra is not None:
             f.write(extra)
             if not args.silent:
-                sys.stdout.write(extra)
+                info_stream(args).write(extra)
 
-def filter_excludes(root, dirs, files, outname, args):
-    if args.verbose:
-        print(f'Processing r={root}, d={dirs}, f={files}')
-    if args.no_recurse:
-        dirs[:] = []
-    dirs[:] = [d for d in dirs if d not in args.exclude]
-    files[:] = [f for f in files if f not in args.exclude]
-    # Remove the file we're creating right now in case it's being created in the same dir
-    files[:] = [f for f in files if f != outname]
-    if not args.include_hidden:
-        dirs[:] = [d for d in dirs if d[0] != '.'] # exclude hidden dirs starting with "."
-        files[:] = [f for f in files if f[0] != '.'] # exclude hidden files
-    if args.verbose:
-        print(f'After exclude filtering at {root}: dirs={dirs}, files={files}')
+GLOB_CHARS = re.compile(r'[*?[]')
 
-# http://stackoverflow.com/questions/24937495
-# http://akiscode.com/articles/sha-1directoryhash.shtml
-# Copyright (c) 2009 Stephen Akiki
-# MIT Licensed
-def hash_dir_contents(dirs, ignore_pattern, args):
-    """Returns a hash (hex digest) of contents of the dir."""
-    import hashlib, os
-    SHAhash = hashlib.sha1()
+class FileFilter:
+    """Compiled name matching for the file collector and archive validation:
+    --exclude names (plain names in a set, glob patterns combined into one
+    regex), hidden files and dirs unless --include-hidden, and the optional
+    ignore pattern (files archived but not hashed)."""
+    def __init__(self, args, ignore_pattern=None):
+        self.names = frozenset(p for p in args.exclude if not GLOB_CHARS.search(p))
+        globs = [fnmatch.translate(os.path.normcase(p)) for p in args.exclude if GLOB_CHARS.search(p)]
+        self.globs = re.compile('|'.join(globs)).match if globs else None
+        self.ignore = re.compile(fnmatch.translate(os.path.normcase(ignore_pattern))).match if ignore_pattern else None
+        self.include_hidden = args.include_hidden
+
+    def excluded(self, name):
+        """True if a file or dir with this name is left out of the artifact."""
+        if name in self.names:
+            return True
+        if not self.include_hidden and name[0] == '.':
+            return True
+        return self.globs is not None and self.globs(os.path.normcase(name)) is not None
 
+    def ignored(self, name):
+        """True if a file with this name is archived but not hashed."""
+        return self.ignore is not None and self.ignore(os.path.normcase(name)) is not None
+
+# A file in the artifact: hashname is the name fed to the content hash, or
+# None if the file matches the ignore pattern (archived but not hashed);
+# arcname is the name of the file in the archive, below the top-level dir;
+# st is its stat result.
+ArtifactFile = collections.namedtuple('ArtifactFile', 'filepath hashname arcname st')
+
+def artifact_tops(dirs, args):
+    """Return the (path, arcname) of each top-level dir or file of the
+    artifact, in hash order; included files go at the top level."""
     if type(dirs) == type(""):
         dirs = [dirs]
+    tops = [(d, d) for d in dirs] + [(f, os.path.basename(f)) for f in args.include]
+    return sorted(tops, key=lambda t: t[0])
+
+def hash_roots(dirs, args):
+    """Return the hash roots of the artifact, for its manifest: a
+    [path in the archive, hash name] for each top-level dir or file, in hash
+    order. The hash name is None for a dir, whose files are hashed under
+    their paths relative to it."""
+    return [[index_path(arcname).lstrip('/'), None if os.path.isdir(path) else path]
+            for path, arcname in artifact_tops(dirs, args)]
+
+@timed_phase('walk')
+def collect_artifact_files(dirs, ignore_pattern, outname, args):
+    """Return the list of ArtifactFiles in the artifact, in hash order (each
+    dir's files, sorted, then its subdirs, sorted), so the hash and the
+    archive writers all work from the same list.
+    Walks with os.scandir, reusing each entry's type and stat. Like os.walk,
+    symlinks to dirs aren't followed and unreadable dirs are skipped.
+    Files named outname (the file being created) are left out.
+    """
+    filt = FileFilter(args, ignore_pattern)
+    files = []
 
-    for d in sorted(dirs + args.include):
+    def add_file(filepath, hashname, arcname, stat):
+        try:
+            st = stat()
+        except OSError as e:
+            raise RuntimeError("collect_artifact_files: exception '%s' processing '%s'"%(e, filepath))
+        files.append(ArtifactFile(filepath, hashname, arcname, st))
+
+    for d, top_arcname in artifact_tops(dirs, args):
         if not os.path.exists (d):
             raise IOError("Dir %s does not exist"%d)
         if os.path.isfile(d):
-            if args.verbose:
-                print("Updating SHA with top-level file %s"%(d))
-            try:
-                SHAhash.update(d.encode('utf-8'))
-                f1 = open(d, 'rb')
-                while 1:
-                    # Read file in as little chunks
-                    buf = f1.read(16384)
-                    if not buf:
-                        break
-                    SHAhash.update(buf)
-                f1.close()
-            except Exception as e:
-                raise RuntimeError("hash_dir_contents: exception %s processing %s"%(e, d))
-        else:
+            add_file(d, d, top_arcname, lambda: os.stat(d))
+            continue
+        stack = [(d, '')]       # (dir, its path relative to d with a trailing '/')
+        while stack:
+            root, relpath = stack.pop()
+            subdirs = []
+            entries = []
             try:
-                for root, dirs, files in os.walk(d):
-                    filter_excludes(root, dirs, files, "", args)
-                    relpath = os.path.relpath(root, d)
-                    dirs.sort()           # make sure order is stable
-                    for name in sorted(files):
-                        if ignore_pattern and fnmatch.fnmatch(name, ignore_pattern):
-                            # print "Ignoring %s" % name
+                with os.scandir(root) as it:
+                    for entry in it:
+                        if filt.excluded(entry.name):
                             continue
-                        filepath = os.path.join(root,name)
-                        # make this stable across OSes since it could be compared on a different OS
-                        # (only used for hashing)
-                        relfilepath = os.path.normpath(os.path.join(relpath, name)).replace('\\', '/')
-                        SHAhash.update(relfilepath.encode('utf-8'))
-                        if args.verbose:
-                            print("Updating SHA with file %s"%(relfilepath))
-                        try:
-                            f1 = open(filepath, 'rb')
-                        except:
-                            raise IOError("Can't open %s for hashing"%filepath)
-                        while 1:
-                            # Read file in as little chunks
-                            buf = f1.read(16384)
-                            if not buf:
-                                break
-                            SHAhash.update(buf)
-                        f1.close()
-            except Exception as e:
-                import traceback
-                traceback.print_exc(file=sys.stderr)
-                raise RuntimeError("hash_dir_contents: exception '%s' processing '%s'"%(e, d))
-    return SHAhash.hexdigest()[0:16]
-
-def make_tarfile(dirs, manifest, manifest_name, outname, top_level_name, outdir, args):
-    """Make a tarfile named <outname>.tgz from all the files in dir
+                        if entry.is_dir():
+                            if not args.no_recurse and not entry.is_symlink():
+                                subdirs.append(entry)
+                        elif entry.name != outname:
+                            entries.append(entry)
+            except OSError:
+                continue
+            subdirs.sort(key=lambda e: e.name)
+            entries.sort(key=lambda e: e.name)
+            if args.verbose:
+                print(f'Processing {root}: dirs={[e.name for e in subdirs]}, files={[e.name for e in entries]}')
+            for entry in entries:
+                # '/'-separated so it's stable across OSes since it could be
+                # compared on a different OS (only used for hashing)
+                hashname = None if filt.ignored(entry.name) else relpath + entry.name
+                add_file(entry.path, hashname, entry.path, entry.stat)
+            for entry in reversed(subdirs):
+                stack.append((entry.path, relpath + entry.name + '/'))
+    return files
+
+# Digest algorithms for --hash-algo; sha1 is the default, so existing
+# artifact names stay valid
+HASH_ALGOS = ('sha1', 'sha256', 'sha512', 'blake2b', 'blake2s', 'sha3_256')
+DEFAULT_HASH_ALGO = 'sha1'
+DEFAULT_READ_SIZE = 1 << 20     # bytes per read when hashing
+DEFAULT_MMAP_THRESHOLD = 64 << 20 # files at least this big are memory-mapped for hashing
+
+# http://stackoverflow.com/questions/24937495
+# http://akiscode.com/articles/sha-1directoryhash.shtml
+# Copyright (c) 2009 Stephen Akiki
+# MIT Licensed
+class ContentHash:
+    """Base class for content hash schemes. If index is set, it also keeps a
+    per-file index of (path, size, digest) for every file hashed.
+    algo is the hashlib algorithm used for all digests (one of HASH_ALGOS)."""
+    parallel = False            # True if per-file digests can be combined in any order
+
+    def __init__(self, index=False, algo=DEFAULT_HASH_ALGO):
+        self.index = [] if index else None
+        self.algo = algo
+        self.file_sha = None
+
+    def start_file(self, hashname, path=None):
+        self.hashname = hashname
+        self.path = path if path is not None else hashname
+        self.size = 0
+        if self.parallel or self.index is not None:
+            self.file_sha = hashlib.new(self.algo)
+
+    def update(self, buf):
+        if self.file_sha is not None:
+            self.file_sha.update(buf)
+        self.size += len(buf)
+
+    def end_file(self):
+        """Finish the current file; return its digest, if per-file digests are kept."""
+        if self.file_sha is None:
+            return None
+        digest = self.file_sha.digest()
+        self.file_sha = None
+        self.add_file_digest(self.hashname, digest, self.path, self.size)
+        return digest
+
+    def add_file_digest(self, hashname, digest, path=None, size=None):
+        if self.index is not None:
+            self.index.append((path if path is not None else hashname, size, digest))
+
+class LegacyContentHash(ContentHash):
+    """The original content hash: a single SHA-1 (or other algo) over each
+    file's name and contents, in hash order. Inherently sequential."""
+    scheme = 'legacy'
+
+    def __init__(self, index=False, algo=DEFAULT_HASH_ALGO):
+        ContentHash.__init__(self, index, algo)
+        self.sha = hashlib.new(algo)
+
+    def start_file(self, hashname, path=None):
+        ContentHash.start_file(self, hashname, path)
+        self.sha.update(hashname.encode('utf-8'))
+
+    def update(self, buf):
+        ContentHash.update(self, buf)
+        self.sha.update(buf)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()[0:HASH_LEN]
+
+class TreeContentHash(ContentHash):
+    """Tree hash (scheme tree-v1): each file's contents are hashed on their own,
+    then the (name, digest) pairs are combined in sorted name order, so files
+    can be hashed in any order or in parallel."""
+    scheme = 'tree-v1'
+    parallel = True
+
+    def __init__(self, index=False, algo=DEFAULT_HASH_ALGO):
+        ContentHash.__init__(self, index, algo)
+        self.files = []
+
+    def add_file_digest(self, hashname, digest, path=None, size=None):
+        ContentHash.add_file_digest(self, hashname, digest, path, size)
+        self.files.append((hashname.encode('utf-8'), digest))
+
+    def hexdigest(self):
+        sha = hashlib.new(self.algo)
+        for name, digest in sorted(self.files):
+            sha.update(name + b'\0' + digest)
+        return sha.hexdigest()[0:HASH_LEN]
+
+HASH_SCHEMES = {c.scheme: c for c in (LegacyContentHash, TreeContentHash)}
+
+def new_content_hash(scheme, index=False, algo=DEFAULT_HASH_ALGO):
+    """Return a content hasher for the named scheme and digest algorithm,
+    optionally keeping a per-file index."""
+    if algo not in HASH_ALGOS:
+        raise RuntimeError("Unknown hash algorithm '%s'" % algo)
+    try:
+        return HASH_SCHEMES[scheme](index, algo)
+    except KeyError:
+        raise RuntimeError("Unknown hash scheme '%s'" % scheme)
+
+def feed_file(filepath, update, args):
+    """Call update(buf) with the contents of a file, in args.read_size pieces,
+    without allocating a new buffer per read: files of at least
+    args.mmap_threshold bytes (if non-zero) are memory-mapped and passed as
+    slices of the mapping, smaller ones are read into one reused buffer.
+    update must not keep buf after returning. Reads are hinted as
+    sequential, and with args.drop_page_cache the file's pages are dropped
+    from the page cache afterwards, so hashing a huge tree doesn't evict
+    everything else."""
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            size = os.fstat(fd).st_size
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if args.mmap_threshold and size >= args.mmap_threshold:
+                with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, 'madvise'):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(m) as view:
+                        for offset in range(0, size, args.read_size):
+                            update(view[offset:offset + args.read_size])
+            else:
+                buf = bytearray(min(args.read_size, size + 1))
+                with memoryview(buf) as view:
+                    while 1:
+                        n = f.readinto(buf)
+                        if not n:
+                            break
+                        update(view[:n])
+            if args.drop_page_cache and hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        raise RuntimeError("hash_dir_contents: exception '%s' processing '%s'"%(e, filepath))
+
+def hash_file(filepath, algo, args):
+    """Return the digest (bytes) of one file's contents."""
+    if stats is not None:
+        start = time.perf_counter()
+    sha = hashlib.new(algo)
+    feed_file(filepath, sha.update, args)
+    if stats is not None:
+        stats.add_file(filepath, os.path.getsize(filepath), time.perf_counter() - start)
+    return sha.digest()
+
+class HashCache:
+    """On-disk cache of per-file digests, keyed by absolute path and checked
+    against the file's (size, mtime_ns, inode). Once there are more than
+    max_entries, the least recently used entries are dropped on save.
+    With no path, it's kept in memory only.
+    Keeps hit/miss/bytes-read counts for the stats line."""
+    VERSION = 1
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = self.misses = self.bytes_read = 0
+        self.generation = 0
+        self.entries = {}
+        try:
+            if path is not None:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.generation = data['generation']
+                    self.entries = data['entries']
+        except (OSError, ValueError, KeyError):
+            pass                # missing or unreadable: start afresh
+        self.generation += 1
+
+    def lookup(self, filepath, st, algo):
+        """Return the cached digest (bytes) for filepath, or None."""
+        entry = self.entries.get(os.path.abspath(filepath))
+        if entry and entry[:4] == [st.st_size, st.st_mtime_ns, st.st_ino, algo]:
+            entry[5] = self.generation
+            self.hits += 1
+            return bytes.fromhex(entry[4])
+        self.misses += 1
+        self.bytes_read += st.st_size
+        return None
+
+    def store(self, filepath, st, algo, digest):
+        self.entries[os.path.abspath(filepath)] = [st.st_size, st.st_mtime_ns, st.st_ino, algo,
+                                                   digest.hex(), self.generation]
+
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            keep = sorted(self.entries.items(), key=lambda kv: kv[1][5])[len(self.entries) - self.max_entries:]
+            self.entries = dict(keep)
+        if self.path is None:
+            return
+        tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump({'version': self.VERSION, 'generation': self.generation,
+                       'entries': self.entries}, f)
+        os.replace(tmpname, self.path)
+
+    def stats(self):
+        return "Hash cache: %d hits, %d misses, %d bytes read" % (self.hits, self.misses, self.bytes_read)
+
+def open_hash_cache(args, hasher):
+    """Return the HashCache to use for this run, or None.
+    Only per-file schemes (tree-v1) can use the cache."""
+    if not args.hash_cache or args.no_hash_cache:
+        return None
+    if not hasher.parallel:
+        logging.warning("Warning: the hash cache is only used with --hash-scheme tree-v1; ignoring it.")
+        return None
+    return HashCache(args.hash_cache, args.hash_cache_size)
+
+def close_hash_cache(cache, args):
+    """Save the cache and print its stats line (on stderr, to keep stdout clean)."""
+    if cache is None:
+        return
+    cache.save()
+    if not args.silent:
+        sys.stderr.write(cache.stats() + "\n")
+
+@timed_phase('hash')
+def hash_dir_contents(dirs, ignore_pattern, args, files=None, index=None, cache=None):
+    """Returns a hash (hex digest) of contents of the dir, using args.hash_scheme.
+    Schemes that allow it hash files in parallel across args.jobs threads,
+    and skip files whose digest is in the hash cache.
+    files is the list from collect_artifact_files, if already collected.
+    If index is a list, the (path, size, digest) of each file is added to it.
+    cache is an open HashCache to use (and leave open) instead of args'."""
+    hasher = new_content_hash(args.hash_scheme, index=index is not None, algo=args.hash_algo)
+    if files is None:
+        files = collect_artifact_files(dirs, ignore_pattern, "", args)
+    files = [(file.filepath, file.hashname, file.st, index_path(file.arcname))
+             for file in files if file.hashname is not None]
+    if args.verbose:
+        for filepath, hashname, st, path in files:
+            print("Updating SHA with file %s"%(hashname))
+    if hasher.parallel:
+        own_cache = cache is None
+        if own_cache:
+            cache = open_hash_cache(args, hasher)
+        digests = {}
+        to_hash = []
+        for filepath, hashname, st, path in files:
+            if cache is None:
+                to_hash.append((filepath, None))
+                continue
+            digest = cache.lookup(filepath, st, hasher.algo)
+            if digest is None:
+                to_hash.append((filepath, st))
+            else:
+                digests[filepath] = digest
+        # hashlib releases the GIL while hashing, so threads are enough here
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            results = pool.map(lambda filepath: hash_file(filepath, hasher.algo, args),
+                               [filepath for filepath, st in to_hash])
+            for (filepath, st), digest in zip(to_hash, results):
+                digests[filepath] = digest
+                if cache is not None:
+                    cache.store(filepath, st, hasher.algo, digest)
+        for filepath, hashname, st, path in files:
+            hasher.add_file_digest(hashname, digests[filepath], path, st.st_size)
+        if own_cache:
+            close_hash_cache(cache, args)
+    else:
+        for filepath, hashname, st, path in files:
+            if stats is not None:
+                start = time.perf_counter()
+            hasher.start_file(hashname, path)
+            feed_file(filepath, hasher.update, args)
+            hasher.end_file()
+            if stats is not None:
+                stats.add_file(filepath, st.st_size, time.perf_counter() - start)
+    if index is not None:
+        index.extend(hasher.index)
+    return hasher.hexdigest()
+
+TAR_CODECS = {
+    # --tar-codec: (file extension, default level, valid levels)
+    'gz': ('.tgz', 9, range(10)),
+    'bz2': ('.tar.bz2', 9, range(1, 10)),
+    'xz': ('.tar.xz', 6, range(10)),
+    'none': ('.tar', None, range(10)),
+}
+
+class BlockGzipWriter:
+    """File object that gzips what's written to it as a series of independent
+    gzip members, starting a new one every block_size bytes of input, so a
+    reader can start decompressing at the start of any block. The result
+    is an ordinary (multi-member) gzip file. blocks lists the (compressed
+    offset, uncompressed offset) where each block starts; fileobj is
+    assumed to start empty, and isn't closed."""
+    def __init__(self, fileobj, level, block_size):
+        if block_size < 1:
+            raise ValueError("BlockGzipWriter block_size must be at least 1, not %s" % block_size)
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.blocks = []
+        self.pos = self.raw_pos = 0
+        self.compressor = None
+
+    def _out(self, data):
+        self.fileobj.write(data)
+        self.raw_pos += len(data)
+
+    def _end_block(self):
+        if self.compressor is not None:
+            self._out(self.compressor.flush())
+            self.compressor = None
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        written = len(data)
+        while len(data):
+            if self.compressor is None:
+                self.blocks.append((self.raw_pos, self.pos))
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31) # gzip wrapper
+            n = min(len(data), self.blocks[-1][1] + self.block_size - self.pos)
+            self._out(self.compressor.compress(data[:n]))
+            self.pos += n
+            data = data[n:]
+            if self.pos - self.blocks[-1][1] == self.block_size:
+                self._end_block()
+        return written
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self._end_block()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_compressor(fileobj, codec, level, block_size=None):
+    """Return a file object that compresses what's written to it with the given
+    --tar-codec and writes it to fileobj (which the caller closes).
+    With a block_size, gz output is a BlockGzipWriter (for --member-index)."""
+    if level is None:
+        level = TAR_CODECS[codec][1]
+    if codec == 'gz' and block_size:
+        return BlockGzipWriter(fileobj, level, block_size)
+    try:
+        if codec == 'gz':
+            import gzip
+            return gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=fileobj)
+        elif codec == 'bz2':
+            import bz2
+            return bz2.BZ2File(fileobj, 'wb', compresslevel=level)
+        elif codec == 'xz':
+            import lzma
+            return lzma.LZMAFile(fileobj, 'wb', preset=level)
+    except ImportError as e:
+        raise RuntimeError("Tar codec %s is not available: %s" % (codec, e))
+    return fileobj
+
+def open_decompressor(fileobj, codec):
+    """Return a file object reading the decompressed contents of fileobj,
+    compressed with the given --tar-codec (fileobj itself for 'none')."""
+    if codec == 'gz':
+        import gzip
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif codec == 'bz2':
+        import bz2
+        return bz2.BZ2File(fileobj, 'rb')
+    elif codec == 'xz':
+        import lzma
+        return lzma.LZMAFile(fileobj, 'rb')
+    return fileobj
+
+@contextlib.contextmanager
+def open_tar_stream(path):
+    """Open the tar file path for reading as a stream (like mode 'r|*').
+    Gzip is read with GzipFile, as tarfile's own stream reader stops at
+    the end of the first member of a multi-member gzip file, such as a
+    block-gzipped (--member-index) tgz."""
+    with open(path, 'rb') as raw:
+        gzipped = raw.read(2) == b'\x1f\x8b'
+        raw.seek(0)
+        with open_decompressor(raw, 'gz' if gzipped else 'none') as src, \
+             tarfile.open(fileobj=src, mode='r|*') as tf:
+            yield tf
+
+class HashingReader:
+    """Wraps a file, feeding everything read from it to a content hasher."""
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        buf = self.f.read(size)
+        if self.hasher is not None:
+            self.hasher.update(buf)
+        return buf
+
+@timed_phase('archive')
+def add_tar_files(f, dirs, files, top_level_name, hasher, cache, args):
+    """Add the dirs' entries and files (from collect_artifact_files) to the
+    tarfile f, feeding each file to hasher (and the hash cache) as it's read,
+    unless its digest is already cached.
+    Returns a list of (header offset, tarinfo) for each member added."""
+    f.copybufsize = args.read_size
+    members = []
+    for dir in dirs:
+        if os.path.isdir(dir):  # top-level files come with the rest
+            members.append((f.offset, f.gettarinfo(dir, '%s/%s' % (top_level_name, dir))))
+            f.addfile(members[-1][1])
+    for filepath, hashname, arcname, st in files:
+        if stats is not None:
+            start = time.perf_counter()
+        hashing = hashname is not None and not use_cached_digest(filepath, hashname, arcname, st,
+                                                                 hasher, cache, args)
+        tinfo = f.gettarinfo(filepath, '%s/%s' % (top_level_name, arcname))
+        members.append((f.offset, tinfo))
+        try:
+            with open(filepath, 'rb') as src:
+                f.addfile(tinfo, HashingReader(src, hasher if hashing else None))
+        except OSError as e:
+            raise RuntimeError("make_tarfile: exception '%s' processing '%s'"%(e, filepath))
+        if hashing:
+            digest = hasher.end_file()
+            if cache is not None:
+                cache.store(filepath, st, hasher.algo, digest)
+        if stats is not None:
+            stats.add_file(filepath, st.st_size, time.perf_counter() - start)
+    return members
+
+def use_cached_digest(filepath, hashname, arcname, st, hasher, cache, args):
+    """Start hashing an artifact file as it's archived; but if its digest is
+    in the hash cache, just add that to hasher and return True (the file is
+    still read, to archive it, but not hashed)."""
+    digest = cache.lookup(filepath, st, hasher.algo) if cache is not None else None
+    if digest is not None:
+        cache.bytes_read += st.st_size # read anyway, to archive it
+        hasher.add_file_digest(hashname, digest, index_path(arcname), st.st_size)
+        return True
+    if args.verbose:
+        print("Updating SHA with file %s"%(hashname))
+    hasher.start_file(hashname, index_path(arcname))
+    return False
+
+def index_path(arcname):
+    """The path of an archive member relative to the top-level dir, as used in the file index."""
+    return os.path.normpath(arcname).replace('\\', '/')
+
+def make_tarfile(dirs, manifest_name, outdir, args):
+    """Make a tarfile named <outname>.tgz (or other extension per args.tar_codec)
+    from all the files in dir, hashing each file as it's archived so the tree
+    is only read once.
     Include the manifest, so the result looks like:
     tar filename: <outname>.tgz
     contents:
@@ -146,19 +767,305 @@ def make_tarfile(dirs, manifest, manifest_name, outname, top_level_name, outdir,
         <manifest>
         dir/
           ...
-    Note: exclude and no-recurse not yet implemented for tar files.
+    Uses the same filtered file list as the hash (exclude, no-recurse, hidden).
+    If the top-level dir is named after the artifact, the tar is first written
+    uncompressed with a same-length placeholder name, the member headers are
+    patched once the hash is known, and then it's compressed (so only the
+    output, not the source tree, is read twice).
+    Returns (tarfilename, outname, hash, bytes of source files read).
+    """
+    ext = TAR_CODECS[args.tar_codec][0]
+    placeholder = fullname(args, '0' * HASH_LEN)
+    tmpname = '%s%s.%d.tmp' % (placeholder, ext, os.getpid())
+    tmpfilename = os.path.join(outdir, tmpname)
+    top_level_name = get_top_dir_name(args, placeholder)
+    staged = args.top_dir_name is None and args.tar_codec != 'none'
+    block_size = args.gzip_block_size if args.member_index else None
+    hasher = new_content_hash(args.hash_scheme, index=args.file_index or args.member_index, algo=args.hash_algo)
+    cache = open_hash_cache(args, hasher)
+    packedname = None
+    try:
+        with open(tmpfilename, 'w+b') as raw:
+            out = raw if staged else open_compressor(raw, args.tar_codec, args.tar_level, block_size)
+            with tarfile.open(fileobj=out, mode='w', dereference=True) as f:
+                files = collect_artifact_files(dirs, "*-manifest.txt", tmpname, args)
+                members = add_tar_files(f, dirs, files, top_level_name, hasher, cache, args)
+                hash = hasher.hexdigest()
+                close_hash_cache(cache, args)
+                outname = placeholder[:-HASH_LEN] + hash
+                if args.top_dir_name is None:
+                    # same-length names, so the headers are the same size
+                    for offset, tinfo in members:
+                        tinfo.name = outname + tinfo.name[len(placeholder):]
+                        raw.seek(offset)
+                        raw.write(tinfo.tobuf(f.format, f.encoding, f.errors))
+                    raw.seek(f.offset)
+                    top_level_name = outname
+                manifest = make_manifest(args, outname, hash, hasher.index if args.file_index else None)
+                try:
+                    members.append((f.offset, None))
+                    f.add(manifest, '%s/%s' % (top_level_name, manifest_name))
+                    members[-1] = (members[-1][0], f.members[-1])
+                finally:
+                    os.unlink(manifest)
+                if args.member_index:
+                    entries = tar_member_index(f, members, top_level_name, hasher.index)
+            if out is not raw:
+                out.close()
+        tarfilename = os.path.join(outdir, "%s%s" % (outname, ext))
+        if staged:
+            # compressed to another temp file, so a failure never leaves a partial tar
+            packedname = '%s.%d.tmp' % (tarfilename, os.getpid())
+            with stats_phase('compress'), open(tmpfilename, 'rb') as src, open(packedname, 'wb') as raw:
+                with open_compressor(raw, args.tar_codec, args.tar_level, block_size) as out:
+                    shutil.copyfileobj(src, out, ZIP_CHUNK_SIZE)
+            os.replace(packedname, tarfilename)
+            os.unlink(tmpfilename)
+        else:
+            os.replace(tmpfilename, tarfilename)
+        if args.member_index:
+            write_member_index(tarfilename, 'tar', top_level_name, entries,
+                               out.blocks if isinstance(out, BlockGzipWriter) else None, args)
+    except:
+        for path in (tmpfilename, packedname):
+            if path and os.path.exists(path):
+                os.unlink(path)
+        raise
+    return tarfilename, outname, hash, sum(file.st.st_size for file in files)
+
+def rename_zip_entries(zf, old_prefix, new_prefix):
+    """Rename the entries of a zipfile open for writing by replacing old_prefix
+    with new_prefix, which must be the same length. The local headers are
+    patched in place; the central directory is written on close.
+    """
+    assert len(old_prefix) == len(new_prefix)
+    for zinfo in zf.infolist():
+        if not zinfo.filename.startswith(old_prefix):
+            continue
+        del zf.NameToInfo[zinfo.filename]
+        zinfo.filename = new_prefix + zinfo.filename[len(old_prefix):]
+        zf.NameToInfo[zinfo.filename] = zinfo
+        try:                    # same rule as zipfile: ascii if possible, else utf-8
+            encoded = zinfo.filename.encode('ascii')
+        except UnicodeEncodeError:
+            encoded = zinfo.filename.encode('utf-8')
+        zf.fp.seek(zinfo.header_offset + ZIP_LOCAL_HEADER_SIZE)
+        zf.fp.write(encoded)
+    zf.fp.seek(zf.start_dir)
+
+# Extensions of files that are already compressed; --compression auto stores them as-is
+STORED_EXTENSIONS = frozenset("""
+    .zip .gz .tgz .bz2 .xz .lz .lzma .zst .7z .rar .cab .jar .whl .apk .nupkg
+    .png .jpg .jpeg .gif .webp .heic .jp2 .mp3 .aac .ogg .opus .m4a .flac
+    .mp4 .m4v .mov .mkv .webm .avi .wmv
+    """.split())
+COMPRESSION_TRIAL_SIZE = 8192   # bytes trial-compressed to decide whether to deflate
+COMPRESSION_TRIAL_RATIO = 0.95  # deflate only if the trial shrinks below this ratio
+
+def choose_compression(name, first_chunk, args):
+    """Return the zip compression type for a file (named name in the archive)
+    from the --compression policy:
+    'auto' stores files with compressed-file extensions, and files whose first
+    few KB don't deflate well; otherwise they're deflated."""
+    if args.compression == 'store':
+        return zipfile.ZIP_STORED
+    if args.compression == 'deflate':
+        return zipfile.ZIP_DEFLATED
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    trial = first_chunk[:COMPRESSION_TRIAL_SIZE]
+    if len(zlib.compress(trial, 1)) > COMPRESSION_TRIAL_RATIO * len(trial):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def deflate_chunk(buf, last, level):
+    """Raw-deflate one chunk of a zip entry on its own. All but the last chunk
+    end with a sync flush, so the compressed chunks concatenate into a single
+    deflate stream. Returns (compressed data, seconds taken)."""
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(buf) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, time.perf_counter() - start
+
+class CompressionStats:
+    """Files, bytes in/out and time spent for one compression type."""
+    def __init__(self):
+        self.files = self.bytes_in = self.bytes_out = 0
+        self.seconds = 0.0
+
+class ZipEntryWriter:
+    """Write entries into a zipfile open for writing, deflating their chunks on
+    an optional thread pool. Entries and chunks are written strictly in the
+    order they're queued, so the output doesn't depend on the number of
+    workers. At most max_pending chunks are held in memory before writing
+    catches up. Keeps CompressionStats per compression type.
+    If streaming, the zip isn't seekable: CRCs and sizes go in data descriptors
+    after each entry instead of being patched into its header.
     """
-    tarfilename = os.path.join(outdir, "%s.tgz" % outname)
-    with tarfile.open(tarfilename, 'w:gz') as f:
-        f.add(manifest, '%s/%s' % (top_level_name, manifest_name))
+    def __init__(self, zf, pool, max_pending, level, streaming=False):
+        self.zf = zf
+        self.streaming = streaming
+        self.pool = pool
+        self.max_pending = max_pending
+        self.level = level
+        self.queue = collections.deque()
+        self.pending = 0
+        self.stats = {zipfile.ZIP_STORED: CompressionStats(), zipfile.ZIP_DEFLATED: CompressionStats()}
+
+    def start_entry(self, zinfo, compress_type, seconds=0.0):
+        """Queue a new entry; seconds is time already spent choosing its compression."""
+        zinfo.compress_type = compress_type
+        self.stats[compress_type].seconds += seconds
+        self.queue.append(('start', zinfo))
+        self.queued_type = compress_type
+
+    def add_chunk(self, buf, last):
+        if self.queued_type == zipfile.ZIP_STORED:
+            self.queue.append(('chunk', (buf, 0.0)))
+        elif self.pool is None:
+            self.queue.append(('chunk', deflate_chunk(buf, last, self.level)))
+        else:
+            self.queue.append(('chunk', self.pool.submit(deflate_chunk, buf, last, self.level)))
+        self.pending += 1
+        self.flush(self.max_pending)
+
+    def end_entry(self, crc, size):
+        self.queue.append(('end', crc, size))
+
+    def flush(self, max_pending=0):
+        """Write queued entries until at most max_pending chunks are left (all, if 0)."""
+        while self.queue and (self.pending > max_pending or max_pending == 0):
+            event = self.queue.popleft()
+            if event[0] == 'start':
+                self._write_header(event[1])
+            elif event[0] == 'chunk':
+                data = event[1]
+                if not isinstance(data, tuple):
+                    data = data.result()
+                data, seconds = data
+                self.pending -= 1
+                self.zf.fp.write(data)
+                self.zinfo.compress_size += len(data)
+                self.stats[self.zinfo.compress_type].seconds += seconds
+            else:
+                self._finish_entry(*event[1:])
+
+    def _write_header(self, zinfo):
+        # Like ZipFile.open(zinfo, 'w'), but the data arrives already compressed
+        zinfo.flag_bits = ZIP_DATA_DESCRIPTOR_FLAG if self.streaming else 0
+        zinfo.compress_size = zinfo.CRC = 0
+        self.zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        if not self.streaming:
+            self.zf.fp.seek(self.zf.start_dir)
+        zinfo.header_offset = self.zf.fp.tell()
+        self.zf.fp.write(zinfo.FileHeader(self.zip64))
+        self.zinfo = zinfo
+
+    def _finish_entry(self, crc, size):
+        zinfo = self.zinfo
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        if not self.zip64 and (size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT):
+            raise RuntimeError("make_zipfile: %s grew too large while being archived" % zinfo.filename)
+        if self.streaming:
+            self.zf.fp.write(struct.pack('<LLQQ' if self.zip64 else '<LLLL', ZIP_DATA_DESCRIPTOR_SIGNATURE,
+                                         crc, zinfo.compress_size, size))
+            self.zf.start_dir = self.zf.fp.tell()
+        else:
+            # Seek back and rewrite the header with the real CRC and sizes
+            self.zf.start_dir = self.zf.fp.tell()
+            self.zf.fp.seek(zinfo.header_offset)
+            self.zf.fp.write(zinfo.FileHeader(self.zip64))
+            self.zf.fp.seek(self.zf.start_dir)
+        self.zf.filelist.append(zinfo)
+        self.zf.NameToInfo[zinfo.filename] = zinfo
+        stats = self.stats[zinfo.compress_type]
+        stats.files += 1
+        stats.bytes_in += size
+        stats.bytes_out += zinfo.compress_size
+
+    def report(self):
+        """Return a summary line for each compression type used."""
+        lines = []
+        for compress_type, label in ((zipfile.ZIP_DEFLATED, 'Deflated'), (zipfile.ZIP_STORED, 'Stored')):
+            stats = self.stats[compress_type]
+            if stats.files:
+                lines.append("%s %d files: %.1f MB -> %.1f MB (saved %.1f MB) in %.2fs" %
+                             (label, stats.files, stats.bytes_in / 1e6, stats.bytes_out / 1e6,
+                              (stats.bytes_in - stats.bytes_out) / 1e6, stats.seconds))
+        return lines
+
+def zipinfo_from_stat(st, arcname):
+    """Like zipfile.ZipInfo.from_file for a regular file, but from a stat
+    result the file collector already has."""
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+@timed_phase('archive')
+def add_zip_files(f, dirs, files, top_level_name, hasher, cache, args, streaming=False):
+    """Add the dirs' entries and files (from collect_artifact_files) to the
+    zipfile f, feeding each file to hasher (and the hash cache) as it's read,
+    unless its digest is already cached."""
+    pool = None
+    if args.jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
         for dir in dirs:
-            f.add(dir, '%s/%s' % (top_level_name, dir))
-        for file in args.include:
-            f.add(file, '%s/%s' % (top_level_name, os.path.basename(file)))
-    return tarfilename
+            if os.path.isdir(dir):  # top-level files come with the rest
+                f.write(dir, '%s/%s' % (top_level_name, dir))
+        writer = ZipEntryWriter(f, pool, max_pending=4 * args.jobs, level=args.compresslevel,
+                                streaming=streaming)
+        for filepath, hashname, arcname, st in files:
+            if stats is not None:
+                start = time.perf_counter()
+            hashing = hashname is not None and not use_cached_digest(filepath, hashname, arcname, st,
+                                                                     hasher, cache, args)
+            zinfo = zipinfo_from_stat(st, '%s/%s' % (top_level_name, arcname))
+            crc = size = 0
+            try:
+                with open(filepath, 'rb') as src:
+                    buf = src.read(ZIP_CHUNK_SIZE)
+                    choose_start = time.perf_counter()
+                    compress_type = choose_compression(arcname, buf, args)
+                    writer.start_entry(zinfo, compress_type, time.perf_counter() - choose_start)
+                    while 1:
+                        # read ahead one chunk to know if this is the last one
+                        next_buf = src.read(ZIP_CHUNK_SIZE) if len(buf) == ZIP_CHUNK_SIZE else b''
+                        if hashing:
+                            hasher.update(buf)
+                        crc = zlib.crc32(buf, crc)
+                        size += len(buf)
+                        writer.add_chunk(buf, last=not next_buf)
+                        if not next_buf:
+                            break
+                        buf = next_buf
+            except OSError as e:
+                raise RuntimeError("make_zipfile: exception '%s' processing '%s'"%(e, filepath))
+            writer.end_entry(crc, size)
+            if hashing:
+                digest = hasher.end_file()
+                if cache is not None:
+                    cache.store(filepath, st, hasher.algo, digest)
+            if stats is not None:
+                stats.add_file(filepath, st.st_size, time.perf_counter() - start)
+        writer.flush()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if stats is not None:
+        stats.compress_seconds += sum(type_stats.seconds for type_stats in writer.stats.values())
+    if not args.silent:
+        for line in writer.report():
+            info_stream(args).write(line + "\n")
 
-def make_zipfile(dirs, manifest, manifest_name, outname, top_level_name, outdir, args):
-    """Make a zipfile named <outname>.zip from all the files in dir
+def make_zipfile(dirs, manifest_name, outdir, args):
+    """Make a zipfile named <outname>.zip from all the files in dir,
+    hashing each file as it's archived so the tree is only read once.
     Include the manifest, so the result looks like:
     zip filename: <outname>.zip
     contents:
@@ -166,21 +1073,54 @@ def make_zipfile(dirs, manifest, manifest_name, outname, top_level_name, outdir,
         <manifest>
         dir/
           ...
-    Exclude any filename in the args.exclude list
+    Exclude any filename in the args.exclude list.
+    The zip is written to a temp file in outdir, then renamed once the hash
+    (and so the full name) is known. If the top-level dir is named after the
+    artifact, the entries are written under a same-length placeholder name and
+    patched in place at the end.
+    Entries are stored or deflated according to args.compression, and deflated
+    in ZIP_CHUNK_SIZE chunks on args.jobs threads; the output is the same for
+    any number of jobs.
+    Returns (zipfilename, outname, hash, bytes of source files read).
     """
-    zipfilename = os.path.join(outdir, "%s.zip" % outname)
-    with zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED) as f:
-        f.write(manifest, '%s/%s' % (top_level_name, manifest_name))
-        for dir in dirs:
-            f.write(dir, '%s/%s' % (top_level_name, dir))
-            for root, dirs, files in os.walk(dir):
-                filter_excludes(root, dirs, files, ('%s.zip' % outname), args)
-                for file in files:
-                    name = os.path.join(root, file)
-                    f.write(name, '%s/%s' % (top_level_name, name))
-        for file in args.include:
-            f.write(file, '%s/%s' % (top_level_name, os.path.basename(file)))
-    return zipfilename
+    placeholder = fullname(args, '0' * HASH_LEN)
+    tmpname = '%s.zip.%d.tmp' % (placeholder, os.getpid())
+    tmpfilename = os.path.join(outdir, tmpname)
+    top_level_name = get_top_dir_name(args, placeholder)
+    hasher = new_content_hash(args.hash_scheme, index=args.file_index or args.member_index, algo=args.hash_algo)
+    cache = open_hash_cache(args, hasher)
+    try:
+        with zipfile.ZipFile(tmpfilename, 'w', zipfile.ZIP_DEFLATED) as f:
+            files = collect_artifact_files(dirs, "*-manifest.txt", tmpname, args)
+            add_zip_files(f, dirs, files, top_level_name, hasher, cache, args)
+            hash = hasher.hexdigest()
+            close_hash_cache(cache, args)
+            outname = placeholder[:-HASH_LEN] + hash
+            if args.top_dir_name is None:
+                rename_zip_entries(f, placeholder + '/', outname + '/')
+                top_level_name = outname
+            manifest = make_manifest(args, outname, hash, hasher.index if args.file_index else None)
+            try:
+                f.write(manifest, '%s/%s' % (top_level_name, manifest_name))
+            finally:
+                os.unlink(manifest)
+            if args.member_index:
+                digests = {path: digest.hex() for path, size, digest in hasher.index}
+                entries = {}
+                for info in f.infolist():
+                    if not info.is_dir():
+                        path = archive_relpath(info.filename, top_level_name)
+                        entries[path] = [info.header_offset, info.compress_size, info.file_size,
+                                         digests.get(path), info.compress_type]
+        zipfilename = os.path.join(outdir, "%s.zip" % outname)
+        os.replace(tmpfilename, zipfilename)
+        if args.member_index:
+            write_member_index(zipfilename, 'zip', top_level_name, entries, None, args)
+    except:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+        raise
+    return zipfilename, outname, hash, sum(file.st.st_size for file in files)
 
 def fullname(args, hash):
     """Return the "full" name of the file, with the relevant args and date included.
@@ -194,77 +1134,1576 @@ def fullname(args, hash):
 
     return outname
 
-def create_artifact(args):
-    orig_cwd=os.getcwd()
-    if args.chdir:
-        os.chdir(args.chdir)
-    hash = hash_dir_contents(sorted(args.dir), ignore_pattern="*-manifest.txt", args=args)
-    outname = fullname(args, hash)
+def stream_artifact(dirs, manifest_name, out, args):
+    """Write the artifact (zip, or tar per args.tar) to out, a stream such as
+    stdout or a pipe that may not be seekable, using bounded memory.
+    Zip entries carry data descriptors since their headers can't be patched.
+    If the top-level dir is named after the artifact, the name has to be known
+    before anything is written, so the tree is hashed first (and checked again
+    while archiving); otherwise it's read only once.
+    Returns (outname, hash, bytes of source files read).
+    """
+    exclude_name = None if args.output in (None, '-') else os.path.basename(args.output)
+    files = collect_artifact_files(dirs, "*-manifest.txt", exclude_name, args)
+    expected_hash = None
     if args.top_dir_name is None:
-        top_dir_name = outname
+        expected_hash = hash_dir_contents(dirs, "*-manifest.txt", args, files=files)
+        top_level_name = fullname(args, expected_hash)
+    else:
+        top_level_name = get_top_dir_name(args, None)
+    hasher = new_content_hash(args.hash_scheme, index=args.file_index, algo=args.hash_algo)
+    cache = open_hash_cache(args, hasher)
+
+    def finish():
+        hash = hasher.hexdigest()
+        close_hash_cache(cache, args)
+        if expected_hash is not None and hash != expected_hash:
+            raise RuntimeError("Source files changed while being archived (hash %s, then %s)"
+                               % (expected_hash, hash))
+        return fullname(args, hash), hash
+
+    if args.tar:
+        compressor = open_compressor(out, args.tar_codec, args.tar_level)
+        with tarfile.open(fileobj=compressor, mode='w|', dereference=True) as f:
+            add_tar_files(f, dirs, files, top_level_name, hasher, cache, args)
+            outname, hash = finish()
+            manifest = make_manifest(args, outname, hash, hasher.index)
+            try:
+                f.add(manifest, '%s/%s' % (top_level_name, manifest_name))
+            finally:
+                os.unlink(manifest)
+        if compressor is not out:
+            compressor.close()
+    else:
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as f:
+            add_zip_files(f, dirs, files, top_level_name, hasher, cache, args, streaming=True)
+            outname, hash = finish()
+            manifest = make_manifest(args, outname, hash, hasher.index)
+            try:
+                f.write(manifest, '%s/%s' % (top_level_name, manifest_name))
+            finally:
+                os.unlink(manifest)
+    out.flush()
+    bytes_read = sum(file.st.st_size for file in files)
+    return outname, hash, bytes_read * 2 if expected_hash is not None else bytes_read
+
+def get_top_dir_name(args, outname):
+    """Return the top-level dir name for the archive contents."""
+    if args.top_dir_name is None:
+        return outname
     elif args.top_dir_name in ('', '.'):
-        top_dir_name = '.'
+        return '.'
     else:
-        top_dir_name = args.top_dir_name
-    manifest_name = '%s-manifest.txt' % args.name
+        return args.top_dir_name
+
+@timed_phase('manifest')
+def make_manifest(args, outname, hash, index=None, extra_lines=''):
+    """Write the manifest for the named artifact to a temp file; return its path.
+    extra_lines (e.g. a delta's) go after the standard lines.
+    The hash-roots line records where the hashed files are, so the hash can
+    be checked from the archive alone.
+    If index is given, append a "file: DIGEST SIZE PATH" line for each file
+    (these aren't echoed to stdout).
+    Also copy it to args.manifest_out, if given."""
     file, manifest = tempfile.mkstemp(prefix='%s-manifest'%args.name)
     os.close(file)
-    extra = "fullname: %s\ncontent-hash: %s\n" % (outname, hash)
-    write_manifest(manifest, args, extra)
-    outdir_path = os.path.join(orig_cwd, args.outdir) # note: this is OK if args.outdir is absolut
-    for d in args.dir:
-        existing_manifest = os.path.join(d, manifest_name)
-        if os.path.exists(existing_manifest):
-            logging.warning("WARNING: %s already exists in source dir %s; deleting from source!" % (manifest_name, d))
-            os.unlink(existing_manifest)
-    if args.tar:
-        resultfile = make_tarfile(args.dir, manifest, manifest_name, outname, top_dir_name,
-                                  outdir_path, args)
+    extra = "fullname: %s\ncontent-hash: %s\nhash-scheme: %s\nhash-algo: %s\nhash-roots: %s\n" % (
+        outname, hash, args.hash_scheme, args.hash_algo, json.dumps(hash_roots(args.dir, args)))
+    if index is not None:
+        extra += "file-count: %d\n" % len(index)
+    write_manifest(manifest, args, extra + extra_lines)
+    if index is not None:
+        with open(manifest, 'a', encoding='utf-8') as f:
+            for path, size, digest in sorted(index):
+                f.write("file: %s %d %s\n" % (digest.hex(), size, path))
+    if args.manifest_out:
+        shutil.copyfile(manifest, args.manifest_out)
+    return manifest
+
+def read_delta_base(path, args):
+    """Return (manifest values, file index {path: (size, hex digest)}) of the
+    base artifact file for --delta-from. If its manifest has no file index,
+    its members are hashed (with args.hash_algo) instead."""
+    index = {}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir()]
+            manifest = find_archive_manifest([info.filename for info in infos])
+            text = zf.read(manifest).decode('utf-8', 'replace') if manifest else ''
+            values = parse_manifest(text)
+            if manifest and 'file-count' not in values:
+                for info in infos:
+                    if info.filename != manifest:
+                        sha = hashlib.new(args.hash_algo)
+                        with zf.open(info) as f:
+                            for buf in iter(lambda: f.read(args.read_size), b''):
+                                sha.update(buf)
+                        index[info.filename] = (info.file_size, sha.hexdigest())
     else:
-        resultfile = make_zipfile(args.dir, manifest, manifest_name, outname, top_dir_name,
-                                  outdir_path, args)
-    os.unlink(manifest)
-    if not args.silent:
-        print("Wrote %s"%resultfile)
-    sys.stderr.write("Created binary artifact %s\n" %resultfile)
+        files = {}
+        manifests = {}      # the text of each possible manifest
+        with open_tar_stream(path) as tf:
+            for member in tf:
+                if member.isfile():
+                    name = posixpath.normpath(member.name).lstrip('/')
+                    is_manifest = fnmatch.fnmatch(posixpath.basename(name), "*-manifest.txt")
+                    sha = hashlib.new(args.hash_algo)
+                    text = []
+                    f = tf.extractfile(member)
+                    for buf in iter(lambda: f.read(args.read_size), b''):
+                        sha.update(buf)
+                        if is_manifest:
+                            text.append(buf)
+                    if is_manifest:
+                        manifests[name] = b''.join(text).decode('utf-8', 'replace')
+                    files[name] = (member.size, sha.hexdigest())
+        manifest = find_archive_manifest(list(files))
+        text = manifests.get(manifest, '')
+        values = parse_manifest(text)
+        files.pop(manifest, None)
+        index = files
+    if manifest is None or 'content-hash' not in values:
+        raise RuntimeError("No manifest found in delta base %s" % path)
+    if 'file-count' in values:
+        if values.get('hash-algo', DEFAULT_HASH_ALGO) != args.hash_algo:
+            raise RuntimeError("Delta base %s is indexed with %s; build the delta with --hash-algo %s"
+                               % (path, values.get('hash-algo', DEFAULT_HASH_ALGO), values.get('hash-algo', DEFAULT_HASH_ALGO)))
+        return values, parse_file_index(text)
+    top = posixpath.dirname(manifest)
+    return values, {posixpath.normpath(name)[len(top) + 1 if top else 0:]: entry
+                    for name, entry in index.items()}
 
-def print_artifact_name(args):
+@timed_phase('delta')
+def make_delta(dirs, manifest_name, outdir, args):
+    """Make a delta artifact against the base artifact args.delta_from: only
+    the files that were added or changed (by per-file digest), laid out as
+    in the full artifact, plus a manifest with the full tree's content hash,
+    the base's content hash and the paths removed since the base.
+    It's named <outname>-delta.zip (or .tgz etc.).
+    Returns (filename, outname, hash, bytes of source files read)."""
+    base_values, base_index = read_delta_base(args.delta_from, args)
+    files = collect_artifact_files(dirs, "*-manifest.txt", "", args)
+    index = []
+    hash = hash_dir_contents(dirs, "*-manifest.txt", args, files=files, index=index)
+    current = {path: (size, digest.hex()) for path, size, digest in index}
+    changed = [file for file in files
+               if file.hashname is None or base_index.get(index_path(file.arcname)) != current[index_path(file.arcname)]]
+    removed = sorted(set(base_index) - set(current))
+    outname = fullname(args, hash)
+    top_level_name = get_top_dir_name(args, outname)
+    ext = TAR_CODECS[args.tar_codec][0] if args.tar else '.zip'
+    filename = os.path.join(outdir, '%s-delta%s' % (outname, ext))
+    tmpfilename = filename + '.%d.tmp' % os.getpid()
+    extra = "delta-from: %s\ndelta-base-hash: %s\ndelta-files: %d\ndelta-removed: %d\n" % (
+        base_values.get('fullname'), base_values['content-hash'],
+        sum(1 for file in changed if file.hashname is not None), len(removed))
+    extra += ''.join("removed: %s\n" % path for path in removed)
+    manifest = make_manifest(args, outname, hash, index if args.file_index else None, extra)
+    try:
+        if args.tar:
+            with open(tmpfilename, 'wb') as raw:
+                with open_compressor(raw, args.tar_codec, args.tar_level) as out:
+                    with tarfile.open(fileobj=out, mode='w', dereference=True) as f:
+                        add_tar_files(f, dirs, changed, top_level_name, ContentHash(), None, args)
+                        f.add(manifest, '%s/%s' % (top_level_name, manifest_name))
+        else:
+            with zipfile.ZipFile(tmpfilename, 'w', zipfile.ZIP_DEFLATED) as f:
+                add_zip_files(f, dirs, changed, top_level_name, ContentHash(), None, args)
+                f.write(manifest, '%s/%s' % (top_level_name, manifest_name))
+        os.replace(tmpfilename, filename)
+    except:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+        raise
+    finally:
+        os.unlink(manifest)
+    return filename, outname, hash, sum(file.st.st_size for file in files)
+
+def member_path(root, name, top):
+    """The path under root to unpack archive member `name` to, relative to
+    the archive's top-level dir `top` ('' for none). Refuses names that
+    would land outside root."""
+    rel = archive_relpath(name, top)
+    if rel == '..' or rel.startswith('../'):
+        raise RuntimeError("Bad archive member path %s" % name)
+    return os.path.join(root, *rel.split('/'))
+
+def extract_member_to(f, path, mode):
+    """Write an archive member's contents (file object f) to path, atomically,
+    creating parent dirs; mode is its permission bits (0 to leave the default)."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as out:
+            shutil.copyfileobj(f, out, ZIP_CHUNK_SIZE)
+        if mode:
+            os.chmod(tmppath, mode)
+        os.replace(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+@timed_phase('delta')
+def apply_delta(args):
+    """Apply the delta artifact args.apply_delta to the unpacked base artifact
+    in args.dir[0]: write the added and changed files, delete the removed
+    ones and replace the manifest, then validate the result against the
+    full content hash with validate_archive. Exits with status 1 if the
+    base doesn't match or the result doesn't validate. The files are
+    written in place, so a result that doesn't validate is left applied."""
+    dir = args.dir[0]
+    manifests = glob.glob("%s/*-manifest.txt" % glob.escape(dir))
+    if not manifests:
+        raise RuntimeError("No manifest found in %s; can't apply a delta to it." % dir)
+    base_values = read_manifest(manifests[0])
+    print("Applying delta %s to %s" % (args.apply_delta, dir))
+
+    def check(values):
+        if 'delta-base-hash' not in values:
+            raise RuntimeError("%s isn't a delta artifact" % args.apply_delta)
+        if values['delta-base-hash'] != base_values.get('content-hash'):
+            print("Delta base mismatch: %s has %s, delta needs %s" %
+                  (dir, base_values.get('content-hash'), values['delta-base-hash']))
+            sys.exit(1)
+
+    if zipfile.is_zipfile(args.apply_delta):
+        with zipfile.ZipFile(args.apply_delta) as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir()]
+            manifest = find_archive_manifest([info.filename for info in infos])
+            if manifest is None:
+                raise RuntimeError("No manifest found in %s" % args.apply_delta)
+            text = zf.read(manifest).decode('utf-8', 'replace')
+            values = parse_manifest(text)
+            check(values)
+            top = posixpath.dirname(manifest)
+            for info in infos:
+                if info.filename != manifest:
+                    with zf.open(info) as f:
+                        extract_member_to(f, member_path(dir, info.filename, top), (info.external_attr >> 16) & 0o777)
+    else:
+        with tarfile.open(args.apply_delta, 'r:*') as tf:
+            members = [m for m in tf.getmembers() if m.isfile()]
+            manifest = find_archive_manifest([posixpath.normpath(m.name) for m in members])
+            if manifest is None:
+                raise RuntimeError("No manifest found in %s" % args.apply_delta)
+            members = {posixpath.normpath(m.name): m for m in members}
+            text = tf.extractfile(members.pop(manifest)).read().decode('utf-8', 'replace')
+            values = parse_manifest(text)
+            check(values)
+            top = posixpath.dirname(manifest)
+            for name, member in members.items():
+                extract_member_to(tf.extractfile(member), member_path(dir, name, top), member.mode & 0o777)
+    for line in text.splitlines():
+        if line.startswith('removed: '):
+            path = member_path(dir, line[len('removed: '):], '')
+            if os.path.exists(path):
+                os.unlink(path)
+                parent = os.path.dirname(path)
+                while os.path.abspath(parent) != os.path.abspath(dir) and not os.listdir(parent):
+                    os.rmdir(parent)
+                    parent = os.path.dirname(parent)
+    # the applied tree gets the full artifact's manifest, without the delta lines
+    for old in manifests:
+        os.unlink(old)
+    with open(os.path.join(dir, posixpath.basename(manifest)), 'w', encoding='utf-8') as f:
+        f.write(''.join(line + '\n' for line in text.splitlines()
+                        if not line.startswith(('delta-', 'removed: '))))
+    try:
+        validate_archive(args)
+    except SystemExit:
+        print("The delta has been applied, so %s no longer matches its base; unpack the base again." % dir)
+        raise
+
+def find_reusable_artifact(outdir, hash, ext, args):
+    """Return the newest artifact file in outdir with the same name, base
+    version and content hash (any date or build id), or None."""
+    pattern = '%s-%s-*%s%s' % (glob.escape(args.name), glob.escape(str(args.base_version)), hash, ext)
+    candidates = [path for path in glob.glob(os.path.join(glob.escape(outdir), pattern))
+                  if os.path.isfile(path)]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+def reusable_manifest(text, hash, args):
+    """Check that an existing artifact's manifest text matches this build's
+    hash settings. Returns its file index as the list of (path, size,
+    digest) make_manifest wants (None if args.file_index is off), or False
+    if the artifact can't be reused."""
+    values = parse_manifest(text)
+    if (values.get('content-hash') != hash or
+        values.get('hash-scheme', LegacyContentHash.scheme) != args.hash_scheme or
+        values.get('hash-algo', DEFAULT_HASH_ALGO) != args.hash_algo):
+        return False
+    if not args.file_index:
+        return None
+    if 'file-count' not in values:
+        return False
+    return [(path, size, bytes.fromhex(digest)) for path, (size, digest)
+            in parse_file_index(text).items()]
+
+def reuse_zipfile(existing, tmpfilename, manifest_name, outname, hash, args):
+    """Turn a copy of an existing zip artifact (at tmpfilename) into this one:
+    rename its entries to the new top-level dir in place and replace the
+    manifest, which is the last entry, with a fresh one. Returns False if
+    that's not possible."""
+    with zipfile.ZipFile(tmpfilename, 'a') as zf:
+        infos = zf.infolist()
+        old_manifest = find_archive_manifest([info.filename for info in infos])
+        if old_manifest is None or infos[-1].filename != old_manifest:
+            return False
+        index = reusable_manifest(zf.read(old_manifest).decode('utf-8', 'replace'), hash, args)
+        if index is False:
+            return False
+        old_top = posixpath.dirname(old_manifest)
+        new_top = get_top_dir_name(args, outname)
+        new_top = '' if new_top == '.' else new_top
+        if old_top != new_top:
+            if not old_top or not new_top or len(old_top) != len(new_top):
+                return False
+            rename_zip_entries(zf, old_top + '/', new_top + '/')
+        # the new manifest overwrites the old one, the last entry
+        last = infos[-1]
+        zf.filelist.remove(last)
+        del zf.NameToInfo[last.filename]
+        zf.start_dir = last.header_offset
+        manifest = make_manifest(args, outname, hash, index)
+        try:
+            zf.write(manifest, posixpath.join(new_top, manifest_name))
+        finally:
+            os.unlink(manifest)
+    return True
+
+def reuse_tarfile(existing, tmpfilename, manifest_name, outname, hash, args):
+    """Turn a copy of an existing tar artifact (at tmpfilename) into this one,
+    with the new top-level dir and a fresh manifest. An uncompressed tar is
+    patched in place (headers renamed, manifest replaced); a compressed one
+    is decompressed and recompressed without touching the source files.
+    Returns False if that's not possible."""
+    with tarfile.open(tmpfilename, 'r:*') as tf:
+        members = tf.getmembers()
+        old_manifest = find_archive_manifest([m.name for m in members if m.isfile()])
+        if old_manifest is None or members[-1].name != old_manifest:
+            return False
+        index = reusable_manifest(tf.extractfile(members[-1]).read().decode('utf-8', 'replace'), hash, args)
+    if index is False:
+        return False
+    old_top = posixpath.dirname(old_manifest)
+    new_top = get_top_dir_name(args, outname)
+    new_top = '' if new_top == '.' else new_top
+    if old_top != new_top and (not old_top or not new_top):
+        return False
+
+    def rename(member):
+        if old_top != new_top and member.name.startswith(old_top + '/'):
+            member.name = new_top + member.name[len(old_top):]
+        return member
+
+    manifest = make_manifest(args, outname, hash, index)
+    try:
+        if args.tar_codec == 'none':
+            if len(old_top) != len(new_top):
+                return False
+            with open(tmpfilename, 'r+b') as raw:
+                for member in members[:-1]:
+                    raw.seek(member.offset)
+                    raw.write(rename(member).tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+                raw.seek(members[-1].offset)
+                with tarfile.open(fileobj=raw, mode='w') as f:
+                    f.add(manifest, posixpath.join(new_top, manifest_name))
+                raw.truncate()
+        else:
+            with open(tmpfilename, 'wb') as raw:
+                with open_tar_stream(existing) as tf, \
+                     open_compressor(raw, args.tar_codec, args.tar_level) as out, \
+                     tarfile.open(fileobj=out, mode='w') as f:
+                    f.copybufsize = args.read_size
+                    for member in tf:
+                        if member.name == old_manifest:
+                            continue
+                        f.addfile(rename(member), tf.extractfile(member) if member.isfile() else None)
+                    f.add(manifest, posixpath.join(new_top, manifest_name))
+    finally:
+        os.unlink(manifest)
+    return True
+
+@timed_phase('reuse')
+def reuse_existing_artifact(dirs, manifest_name, outdir, args):
+    """For --reuse-existing: hash the files, and if outdir already has an
+    artifact with the same name, base version and hash, copy it under the
+    new name with a fresh manifest instead of archiving the files again.
+    Returns (filename, outname, hash, bytes of source files read), or None
+    if there's nothing to reuse (then the artifact is built as usual)."""
+    ext = TAR_CODECS[args.tar_codec][0] if args.tar else '.zip'
+    files = collect_artifact_files(dirs, "*-manifest.txt", "", args)
+    hash = hash_dir_contents(dirs, "*-manifest.txt", args, files=files)
+    existing = find_reusable_artifact(outdir, hash, ext, args)
+    if existing is None:
+        return None
+    outname = fullname(args, hash)
+    filename = os.path.join(outdir, outname + ext)
+    tmpfilename = os.path.join(outdir, '%s%s.%d.tmp' % (outname, ext, os.getpid()))
+    try:
+        shutil.copyfile(existing, tmpfilename)
+        reuse = reuse_tarfile if args.tar else reuse_zipfile
+        if not reuse(existing, tmpfilename, manifest_name, outname, hash, args):
+            os.unlink(tmpfilename)
+            sys.stderr.write("Can't reuse %s (different layout or manifest); building as usual\n" % existing)
+            return None
+        os.replace(tmpfilename, filename)
+    except:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+        raise
+    sys.stderr.write("Reused existing artifact %s (same content) with a new manifest\n" % existing)
+    return filename, outname, hash, sum(file.st.st_size for file in files)
+
+# What create_artifact made: path is the artifact file (None on stdout),
+# name its full name (without extension), hash the content hash and
+# bytes_read the number of bytes of source files read.
+ArtifactResult = collections.namedtuple('ArtifactResult', 'path name hash bytes_read')
+
+def store_blob_path(store, algo, digest):
+    """Path of the blob with the given hex digest in the artifact store."""
+    return os.path.join(store, 'blobs', algo, digest[:2], digest[2:])
+
+def store_index_path(store, outname):
+    """Path of the named artifact's index in the artifact store."""
+    return os.path.join(store, 'artifacts', outname + '.json')
+
+def write_atomically(path, write):
+    """Create path by calling write(f) on a temp file next to it, then renaming it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as f:
+            write(f)
+        os.replace(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+@timed_phase('store')
+def store_artifact(dirs, manifest_name, args):
+    """Put the artifact in the content-addressed store args.store instead of
+    archiving it: each file's contents are stored once, as a blob named by
+    its digest (args.hash_algo), and the artifact itself is an index of its
+    manifest and each file's path, size, mode, mtime and digest.
+    Files whose digest is in the hash cache and already stored aren't read;
+    new blobs are copied after hashing, so files already in the store are
+    never written.
+    Returns (index filename, outname, hash, bytes of source files read)."""
+    hasher = new_content_hash(args.hash_scheme, index=True, algo=args.hash_algo)
+    unhashed = ContentHash(index=True, algo=args.hash_algo)
+    cache = open_hash_cache(args, hasher)
+    files = collect_artifact_files(dirs, "*-manifest.txt", "", args)
+    entries = []
+    bytes_read = 0
+    for filepath, hashname, arcname, st in files:
+        file_hasher = hasher if hashname is not None else unhashed
+        digest = cache.lookup(filepath, st, file_hasher.algo) if cache is not None else None
+        if digest is None or not os.path.exists(store_blob_path(args.store, args.hash_algo, digest.hex())):
+            file_hasher.start_file(hashname or arcname, index_path(arcname))
+            feed_file(filepath, file_hasher.update, args)
+            digest = file_hasher.end_file()
+            bytes_read += st.st_size
+            if cache is not None and hashname is not None:
+                cache.store(filepath, st, file_hasher.algo, digest)
+        else:
+            file_hasher.add_file_digest(hashname or arcname, digest, index_path(arcname), st.st_size)
+        blob = store_blob_path(args.store, args.hash_algo, digest.hex())
+        if not os.path.exists(blob):
+            def copy(out):
+                sha = hashlib.new(args.hash_algo)
+                def update(buf):
+                    out.write(buf)
+                    sha.update(buf)
+                feed_file(filepath, update, args)
+                if sha.digest() != digest:
+                    raise RuntimeError("store_artifact: %s changed while being stored" % filepath)
+            write_atomically(blob, copy)
+            bytes_read += st.st_size
+        entries.append([index_path(arcname), st.st_size, st.st_mode & 0o7777,
+                        st.st_mtime, digest.hex()])
+    close_hash_cache(cache, args)
+    hash = hasher.hexdigest()
+    outname = fullname(args, hash)
+    manifest = make_manifest(args, outname, hash, hasher.index if args.file_index else None)
+    try:
+        with open(manifest, encoding='utf-8') as f:
+            manifest_text = f.read()
+    finally:
+        os.unlink(manifest)
+    index = {'name': outname, 'content-hash': hash, 'hash-algo': args.hash_algo,
+             'top-dir': get_top_dir_name(args, outname),
+             'dirs': [index_path(d) for d in dirs if os.path.isdir(d)],
+             'manifest-name': manifest_name, 'manifest': manifest_text, 'files': entries}
+    filename = store_index_path(args.store, outname)
+    write_atomically(filename, lambda f: f.write(json.dumps(index, indent=1).encode('utf-8')))
+    return filename, outname, hash, bytes_read
+
+def read_store_indexes(store):
+    """Return {artifact name: index} for every artifact in the store."""
+    indexes = {}
+    for path in sorted(glob.glob(os.path.join(glob.escape(store), 'artifacts', '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+        indexes[index['name']] = index
+    return indexes
+
+def store_blob_refcounts(indexes):
+    """Return {(algo, hex digest): number of references from artifact files}."""
+    refs = collections.Counter()
+    for index in indexes.values():
+        for path, size, mode, mtime, digest in index['files']:
+            refs[(index['hash-algo'], digest)] += 1
+    return refs
+
+def store_blobs(store):
+    """Return {(algo, hex digest): size on disk} for every blob in the store."""
+    blobs = {}
+    for path in glob.glob(os.path.join(glob.escape(store), 'blobs', '*', '??', '*')):
+        if not path.endswith('.tmp'):
+            algo_dir, prefix = os.path.split(os.path.dirname(path))
+            blobs[(os.path.basename(algo_dir), prefix + os.path.basename(path))] = os.path.getsize(path)
+    return blobs
+
+def export_from_store(index, outdir, args):
+    """Write a standard zip (or tar, with args.tar) of an artifact in the store
+    to outdir; returns its filename. It validates like the original, though
+    it's not byte-for-byte the same (compression and dir entries may differ)."""
+    top = index['top-dir']
+    ext = TAR_CODECS[args.tar_codec][0] if args.tar else '.zip'
+    filename = os.path.join(outdir, index['name'] + ext)
+    manifest = index['manifest'].encode('utf-8')
+    def member_name(path):
+        return posixpath.normpath(posixpath.join(top, index_path(path)))
+    # a '.' dir is the top-level dir itself, which gets no entry
+    dirs = [member_name(dir) for dir in index['dirs'] if index_path(dir) != '.']
+    blobs = [(store_blob_path(args.store, index['hash-algo'], digest), member_name(path), size, mode, mtime)
+             for path, size, mode, mtime, digest in index['files']]
+    for blob, arcname, size, mode, mtime in blobs:
+        if not os.path.exists(blob):
+            raise RuntimeError("Blob for %s is missing from the store" % arcname)
+    def write_tar(raw):
+        with open_compressor(raw, args.tar_codec, args.tar_level) as out:
+            with tarfile.open(fileobj=out, mode='w') as f:
+                for dir in dirs:
+                    tinfo = tarfile.TarInfo(dir)
+                    tinfo.type, tinfo.mode, tinfo.mtime = tarfile.DIRTYPE, 0o755, time.time()
+                    f.addfile(tinfo)
+                for blob, arcname, size, mode, mtime in blobs:
+                    tinfo = tarfile.TarInfo(arcname)
+                    tinfo.size, tinfo.mode, tinfo.mtime = size, mode, mtime
+                    with open(blob, 'rb') as src:
+                        f.addfile(tinfo, src)
+                tinfo = tarfile.TarInfo(member_name(index['manifest-name']))
+                tinfo.size, tinfo.mtime = len(manifest), time.time()
+                f.addfile(tinfo, io.BytesIO(manifest))
+    def write_zip(raw):
+        with zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED) as f:
+            for dir in dirs:
+                f.writestr(zipfile.ZipInfo(dir + '/', time.localtime()[0:6]), b'')
+            files = [ArtifactFile(blob, None, arcname,
+                                  os.stat_result((stat.S_IFREG | mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime)))
+                     for blob, arcname, size, mode, mtime in blobs]
+            add_zip_files(f, [], files, '', ContentHash(), None, args)
+            f.writestr(member_name(index['manifest-name']), manifest)
+    write_atomically(filename, write_tar if args.tar else write_zip)
+    return filename
+
+@timed_phase('store')
+def run_store_command(args):
+    """Run the --store-cmd command on the artifact store args.store:
+    ls (each artifact's files, size and bytes not shared with any other),
+    du (total size vs. stored size, and the space saved by deduplication),
+    gc (delete blobs no artifact refers to), rm NAME... (remove artifacts,
+    then gc) or export NAME... (write them to --outdir as zip/tar files)."""
+    indexes = read_store_indexes(args.store)
+    if args.store_cmd in ('rm', 'export'):
+        for name in args.dir:
+            if name not in indexes:
+                raise RuntimeError("No artifact %s in store %s" % (name, args.store))
+    if args.store_cmd == 'export':
+        for name in args.dir:
+            print("Wrote %s" % export_from_store(indexes[name], args.outdir, args))
+        return
+    if args.store_cmd == 'rm':
+        for name in args.dir:
+            os.unlink(store_index_path(args.store, name))
+            del indexes[name]
+            print("Removed %s" % name)
+    refs = store_blob_refcounts(indexes)
+    blobs = store_blobs(args.store)
+    if args.store_cmd == 'ls':
+        width = max([len(name) for name in indexes] + [len('artifact')])
+        print("%-*s %8s %14s %14s" % (width, 'artifact', 'files', 'size', 'unique'))
+        for name, index in indexes.items():
+            unique = sum(size for path, size, mode, mtime, digest in index['files']
+                         if refs[(index['hash-algo'], digest)] == 1)
+            print("%-*s %8d %14d %14d" % (width, name, len(index['files']),
+                                        sum(entry[1] for entry in index['files']), unique))
+    elif args.store_cmd == 'du':
+        total = sum(entry[1] for index in indexes.values() for entry in index['files'])
+        stored = sum(blobs.values())
+        print("Artifacts: %d, files: %d, size %d bytes" % (
+            len(indexes), sum(len(index['files']) for index in indexes.values()), total))
+        print("Blobs: %d, stored %d bytes; dedup saved %d bytes (%.1f%%)" % (
+            len(blobs), stored, total - stored, 100.0 * (total - stored) / total if total else 0))
+    else:                       # gc, rm
+        garbage = [key for key in blobs if refs[key] == 0]
+        for algo, digest in garbage:
+            os.unlink(store_blob_path(args.store, algo, digest))
+        print("Deleted %d unreferenced blobs (%d bytes)" % (len(garbage), sum(blobs[key] for key in garbage)))
+
+def create_artifact(args):
+    """Create the artifact described by args; returns an ArtifactResult.
+    The working dir is restored afterwards, even with args.chdir."""
     orig_cwd=os.getcwd()
     if args.chdir:
         os.chdir(args.chdir)
-    hash = hash_dir_contents(args.dir, ignore_pattern="*-manifest.txt", args=args)
-    print(fullname(args, hash))
+    try:
+        manifest_name = '%s-manifest.txt' % args.name
+        outdir_path = os.path.join(orig_cwd, args.outdir) # note: this is OK if args.outdir is absolut
+        for d in args.dir:
+            existing_manifest = os.path.join(d, manifest_name)
+            if os.path.exists(existing_manifest):
+                logging.warning("WARNING: %s already exists in source dir %s; deleting from source!" % (manifest_name, d))
+                os.unlink(existing_manifest)
+        if args.output == '-':
+            outname, hash, bytes_read = stream_artifact(sorted(args.dir), manifest_name, sys.stdout.buffer, args)
+            resultfile = '%s%s (on stdout)' % (outname, TAR_CODECS[args.tar_codec][0] if args.tar else '.zip')
+            path = None
+        elif args.output:
+            path = os.path.join(orig_cwd, args.output)
+            with open(path, 'wb') as out:
+                outname, hash, bytes_read = stream_artifact(sorted(args.dir), manifest_name, out, args)
+            resultfile = '%s%s (in %s)' % (outname, TAR_CODECS[args.tar_codec][0] if args.tar else '.zip',
+                                           args.output)
+        else:
+            reused = None
+            if args.store:
+                reused = store_artifact(sorted(args.dir), manifest_name, args)
+            elif args.delta_from:
+                reused = make_delta(sorted(args.dir), manifest_name, outdir_path, args)
+            elif args.reuse_existing and not args.member_index:
+                reused = reuse_existing_artifact(sorted(args.dir), manifest_name, outdir_path, args)
+            if reused is not None:
+                resultfile, outname, hash, bytes_read = reused
+            elif args.tar:
+                resultfile, outname, hash, bytes_read = make_tarfile(sorted(args.dir), manifest_name, outdir_path, args)
+            else:
+                resultfile, outname, hash, bytes_read = make_zipfile(sorted(args.dir), manifest_name, outdir_path, args)
+            path = resultfile
+    finally:
+        os.chdir(orig_cwd)
+    if stats is not None and path is not None:
+        stats.bytes_written += os.path.getsize(path)
+    if not args.silent:
+        info_stream(args).write("Wrote %s\n"%resultfile)
+    sys.stderr.write("Created binary artifact %s\n" %resultfile)
+    return ArtifactResult(path, outname, hash, bytes_read)
 
-def print_artifact_hash(args):
-    orig_cwd=os.getcwd()
+# The options that a --serve query passes on, since they decide the content hash
+HASH_QUERY_OPTIONS = ('dir', 'include', 'exclude', 'include_hidden', 'no_recurse', 'hash_scheme', 'hash_algo')
+HASH_QUERY_TIMEOUT = 2.0        # seconds --serve waits on a client to send its query (or read the reply)
+
+def query_hash_server(args):
+    """Ask the --serve daemon at args.server for the content hash of the
+    artifact described by args; returns it, or None if there's no daemon
+    there (or it fails), so the caller can hash the files itself."""
+    if not args.server or not hasattr(socket, 'AF_UNIX'):
+        return None
+    query = {option: getattr(args, option) for option in HASH_QUERY_OPTIONS}
+    query['op'] = 'hash'
+    query['cwd'] = os.path.abspath(args.chdir or os.curdir)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1.0)
+            sock.connect(args.server)
+            sock.settimeout(None)   # hashing changed files may take a while
+            sock.sendall(json.dumps(query).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                reply = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        if args.verbose:
+            print("No hash server at %s (%s); hashing directly" % (args.server, e))
+        return None
+    if 'error' in reply:
+        if args.verbose:
+            print("Hash server error: %s; hashing directly" % reply['error'])
+        return None
+    return reply.get('hash')
+
+def artifact_content_hash(args):
+    """The content hash of the artifact described by args: from the --serve
+    daemon if there's one, otherwise by hashing the files (in args.chdir)."""
+    hash = query_hash_server(args)
+    if hash is not None:
+        return hash
     if args.chdir:
         os.chdir(args.chdir)
-    hash = hash_dir_contents(args.dir, ignore_pattern="*-manifest.txt", args=args)
-    print(hash)
+    return hash_dir_contents(args.dir, ignore_pattern="*-manifest.txt", args=args)
+
+def print_artifact_name(args):
+    print(fullname(args, artifact_content_hash(args)))
+
+def print_artifact_hash(args):
+    print(artifact_content_hash(args))
+
+class HashServer:
+    """The --serve daemon: answers content hash queries for any number of
+    source trees, keeping per-file digests in memory. Each query re-walks
+    its tree (stat calls only) and rehashes just the files whose stat
+    changed, so answers are never stale; between queries, every tree seen
+    is polled each args.poll_interval seconds and changed files are
+    rehashed in the background, so the next query finds them ready.
+    Trees not queried for args.idle_expiry seconds are forgotten.
+    The digests only help schemes that combine per-file digests (tree-v1);
+    a legacy tree is reread in full whenever anything in it changes.
+    Single-threaded: each tree is hashed from its own cwd, and each client
+    has HASH_QUERY_TIMEOUT seconds to send its query."""
+    def __init__(self, args):
+        self.args = args
+        self.cache = HashCache(None, args.hash_cache_size)
+        self.trees = {}         # query key: [args, cwd, snapshot, hash, time of last query]
+
+    def tree_hash(self, tree):
+        """Bring a tree's hash up to date; returns (hash, whether it changed)."""
+        args, cwd, snapshot, hash = tree[:4]
+        os.chdir(cwd)
+        files = collect_artifact_files(args.dir, "*-manifest.txt", "", args)
+        new_snapshot = [(file.filepath, file.hashname, file.st.st_size, file.st.st_mtime_ns, file.st.st_ino)
+                        for file in files]
+        if new_snapshot == snapshot:
+            return hash, False
+        tree[3] = hash_dir_contents(args.dir, "*-manifest.txt", args, files=files, cache=self.cache)
+        tree[2] = new_snapshot
+        self.cache.save()       # just evicts, since it's in memory
+        return tree[3], True
+
+    def answer(self, query):
+        """Return the reply (a dict) to one query."""
+        if query.get('op') != 'hash':
+            return {'error': "unknown op %s" % query.get('op')}
+        self.expire()
+        key = json.dumps(query, sort_keys=True)
+        tree = self.trees.get(key)
+        if tree is None:
+            args = argparse.Namespace(**vars(self.args))
+            for option in HASH_QUERY_OPTIONS:
+                setattr(args, option, query[option])
+            if not new_content_hash(args.hash_scheme, algo=args.hash_algo).parallel: # also checks they're known
+                print("Note: %s in %s uses the %s scheme, which has no per-file digests to keep;"
+                      " any change rereads the whole tree" % (' '.join(args.dir), query['cwd'], args.hash_scheme))
+            tree = self.trees[key] = [args, query['cwd'], None, None, None]
+        tree[4] = time.monotonic()
+        hash, changed = self.tree_hash(tree)
+        print("%s %s in %s: %s" % ('Hashed' if changed else 'Unchanged', ' '.join(tree[0].dir), tree[1], hash))
+        return {'hash': hash}
+
+    def expire(self):
+        """Forget the trees that haven't been asked about for args.idle_expiry seconds."""
+        now = time.monotonic()
+        for key, tree in list(self.trees.items()):
+            if now - tree[4] > self.args.idle_expiry:
+                print("Forgetting %s in %s: idle" % (' '.join(tree[0].dir), tree[1]))
+                del self.trees[key]
+
+    def poll(self):
+        """Rehash any changed files in the trees seen so far; forget trees that are gone."""
+        self.expire()
+        for key, tree in list(self.trees.items()):
+            try:
+                hash, changed = self.tree_hash(tree)
+            except (OSError, RuntimeError) as e:
+                print("Dropping %s in %s: %s" % (' '.join(tree[0].dir), tree[1], e))
+                del self.trees[key]
+                continue
+            if changed:
+                print("Rehashed %s in %s: %s" % (' '.join(tree[0].dir), tree[1], hash))
+
+    def serve(self, path):
+        """Serve queries on the Unix socket at path until interrupted (or a 'stop' query)."""
+        if not hasattr(socket, 'AF_UNIX'):
+            raise RuntimeError("--serve needs Unix domain sockets, which this OS doesn't have")
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(path) == 0:
+                    raise RuntimeError("A hash server is already running on %s" % path)
+            os.unlink(path)     # stale
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen(16)
+            server.settimeout(self.args.poll_interval or None)
+            print("Serving content hashes on %s" % path)
+            sys.stdout.flush()
+            while 1:
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    self.poll()
+                    sys.stdout.flush()
+                    continue
+                # one at a time, so a client that never sends its query mustn't hold up the rest
+                conn.settimeout(HASH_QUERY_TIMEOUT)
+                with conn, conn.makefile('rwb') as f:
+                    try:
+                        query = json.loads(f.readline())
+                        if query.get('op') == 'stop':
+                            f.write(b'{}\n')
+                            break
+                        reply = self.answer(query)
+                    except (OSError, RuntimeError, ValueError, KeyError, TypeError) as e:
+                        reply = {'error': str(e)}
+                    try:
+                        f.write(json.dumps(reply).encode('utf-8') + b'\n')
+                        f.flush()
+                    except OSError:
+                        pass    # client went away
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(path)
+        print("Stopped serving on %s" % path)
+
+def parse_manifest(text):
+    """Return the "key: value" lines of a manifest's text as a dict
+    (except the file index; see parse_file_index)."""
+    values = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(': ')
+        if sep and key != 'file':
+            values[key] = value
+    return values
+
+def parse_file_index(text):
+    """Return the file index in a manifest's text as a dict of path: (size, hex digest)."""
+    index = {}
+    for line in text.splitlines():
+        if line.startswith('file: '):
+            digest, size, path = line[len('file: '):].split(' ', 2)
+            index[path] = (int(size), digest)
+    return index
+
+def read_manifest(manifest):
+    """Return the "key: value" lines of a manifest file as a dict
+    (except the file index; see read_file_index)."""
+    with open(manifest, 'rb') as f:
+        return parse_manifest(f.read(1024*1024).decode('utf-8', 'replace'))
+
+def read_file_index(manifest):
+    """Return the manifest file's index as a dict of path: (size, hex digest)."""
+    with open(manifest, 'r', encoding='utf-8') as f:
+        return parse_file_index(f.read())
+
+def check_indexed_file(filepath, size, digest, cache, args):
+    """Check a file's stat, and its digest if the hash cache has it, against
+    its index entry (hashed with args.hash_algo). Returns (problem, st):
+    problem is None if it matches, or what's wrong with it; st is its stat
+    if it still has to be hashed to tell."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return 'Missing', None
+    if st.st_size != size:
+        return 'Changed', None
+    actual = cache.lookup(filepath, st, args.hash_algo) if cache is not None else None
+    if actual is None:
+        return None, st
+    return (None if actual.hex() == digest else 'Changed'), None
+
+def validate_file_index(dir, manifest, args):
+    """Check an unpacked archive file by file against the manifest's file index.
+    Reports each missing, extra or changed file, or just the first one with
+    args.fail_fast. Files whose stat matches the hash cache aren't re-read;
+    the rest are hashed on args.jobs threads (the cache is only used from
+    this one). Returns True if everything matches."""
+    index = read_file_index(manifest)
+    cache = None
+    if args.hash_cache and not args.no_hash_cache:
+        cache = HashCache(args.hash_cache, args.hash_cache_size)
+    problems = []
+    for filepath, hashname, arcname, st in collect_artifact_files(dir, "*-manifest.txt", "", args):
+        if hashname is not None and hashname not in index:
+            problems.append(('Extra', hashname))
+    to_hash = []
+    for path, (size, digest) in index.items():
+        if problems and args.fail_fast:
+            break
+        filepath = os.path.join(dir, path)
+        problem, st = check_indexed_file(filepath, size, digest, cache, args)
+        if problem is not None:
+            problems.append((problem, path))
+        elif st is not None:
+            to_hash.append((path, filepath, st, digest))
+    if to_hash and not (problems and args.fail_fast):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(hash_file, filepath, args.hash_algo, args): (path, filepath, st, digest)
+                       for path, filepath, st, digest in to_hash}
+            for future in concurrent.futures.as_completed(futures):
+                path, filepath, st, digest = futures[future]
+                actual = future.result()
+                if cache is not None:
+                    cache.store(filepath, st, args.hash_algo, actual)
+                if actual.hex() != digest:
+                    problems.append(('Changed', path))
+                    if args.fail_fast:
+                        for f in futures:
+                            f.cancel()
+                        break
+    close_hash_cache(cache, args)
+    return report_index_problems(problems, len(index), args)
+
+def report_index_problems(problems, count, args):
+    """Print a list of (problem, path) found checking files against a file
+    index, or that all count files are OK. Returns True if there were none."""
+    problems.sort(key=lambda p: p[1])
+    if args.fail_fast:
+        problems = problems[:1]
+    for problem, path in problems:
+        print("%s: %s" % (problem, path))
+    if problems:
+        counts = collections.Counter(problem for problem, path in problems)
+        print("Index mismatch: %d missing, %d extra, %d changed" %
+              (counts['Missing'], counts['Extra'], counts['Changed']))
+        return False
+    print("Files OK: %d files match the index." % count)
+    return True
+
+def compare_file_index(index, actual, args):
+    """Compare a file index with the actual {path: (size, hex digest)} of an
+    archive's members; returns True if they match."""
+    problems = [('Extra', path) for path in actual if path not in index]
+    for path, entry in index.items():
+        if path not in actual:
+            problems.append(('Missing', path))
+        elif actual[path] != entry:
+            problems.append(('Changed', path))
+    return report_index_problems(problems, len(index), args)
+
+def manifest_hash_roots(values):
+    """Return the hash roots (see hash_roots) from a manifest's values;
+    manifests from before they were recorded are taken to hash the whole
+    tree below the top-level dir."""
+    if 'hash-roots' not in values:
+        return [['.', None]]
+    return json.loads(values['hash-roots'])
+
+def archive_member_hash(name, top, roots, filt, args):
+    """Return (path, sort key, hash name) for archive member `name` (a file):
+    its path relative to the top-level dir `top` ('' for none), a key that
+    sorts members into hash order, and the name the content hash saw it
+    under, given the artifact's hash roots (filtered by the FileFilter filt,
+    as hash_dir_contents would). None if it isn't hashed."""
+    name = posixpath.normpath(name).lstrip('/')
+    if top:
+        if not name.startswith(top + '/'):
+            return None
+        name = name[len(top) + 1:]
+    for i, (root, hashname) in enumerate(roots):
+        if hashname is not None:
+            if name == root:
+                return name, (i,), hashname
+            continue
+        if root == '.':
+            inner = name
+        elif name.startswith(root + '/'):
+            inner = name[len(root) + 1:]
+        else:
+            continue
+        parts = inner.split('/')
+        if args.no_recurse and len(parts) > 1:
+            return None
+        if any(filt.excluded(part) for part in parts) or filt.ignored(parts[-1]):
+            return None
+        return name, (i,) + walk_order_key(inner), inner
+    return None
+
+def walk_order_key(hashname):
+    """Sort key that puts hash names in the order an unpacked tree is walked
+    (each dir's files, sorted, then its subdirs, sorted)."""
+    parts = hashname.split('/')
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+def find_archive_manifest(names):
+    """Return the shallowest *-manifest.txt among archive member names, or None."""
+    manifests = [n for n in names if fnmatch.fnmatch(posixpath.basename(n), "*-manifest.txt")]
+    if not manifests:
+        return None
+    return min(manifests, key=lambda n: (n.count('/'), n))
+
+def check_archive_hash(values, hash, manifest):
+    """Print and check the archive's content hash against its manifest values."""
+    if 'delta-base-hash' in values:
+        print("%s is a delta against %s; apply it to that (--apply-delta) to validate it."
+              % (values.get('fullname'), values.get('delta-from')))
+        sys.exit(1)
+    if hash != values['content-hash']:
+        print("Hash mismatch: actual %s, expected %s" % (hash, values['content-hash']))
+        sys.exit(1)
+    print("Hash OK: %s."%hash)
+
+def validate_zipfile(path, args):
+    """Validate a zip artifact without unpacking it, streaming each member
+    through the hash in walk order."""
+    filt = FileFilter(args, "*-manifest.txt")
+    with zipfile.ZipFile(path) as zf:
+        infos = [info for info in zf.infolist() if not info.is_dir()]
+        manifest = find_archive_manifest([info.filename for info in infos])
+        if manifest is None:
+            print("No manifest found in %s; can't validate." % path)
+            return
+        text = zf.read(manifest).decode('utf-8', 'replace')
+        values = parse_manifest(text)
+        top = posixpath.dirname(manifest)
+        roots = manifest_hash_roots(values)
+        members = []
+        for info in infos:
+            hashed = archive_member_hash(info.filename, top, roots, filt, args)
+            if hashed is not None:
+                members.append(hashed + (info,))
+        members.sort(key=lambda m: m[1])
+        index = 'file-count' in values and not args.full_hash
+        if not index and 'content-hash' not in values:
+            print("Can't find hash line in manifest %s" % manifest)
+            return
+        hasher = new_content_hash(values.get('hash-scheme', LegacyContentHash.scheme), index=index,
+                                  algo=values.get('hash-algo', DEFAULT_HASH_ALGO))
+        for rel, key, hashname, info in members:
+            hasher.start_file(hashname, rel)
+            with zf.open(info) as f:
+                while 1:
+                    buf = f.read(args.read_size)
+                    if not buf:
+                        break
+                    hasher.update(buf)
+            hasher.end_file()
+    if index:
+        actual = {path: (size, digest.hex()) for path, size, digest in hasher.index}
+        if not compare_file_index(parse_file_index(text), actual, args):
+            sys.exit(1)
+    else:
+        check_archive_hash(values, hasher.hexdigest(), manifest)
+
+def guess_hash_roots(rel, layout, filt):
+    """Return the hash roots that archive member path rel (relative to a
+    possible top-level dir) implies for a possible layout: 'tree' for one
+    dir hashed from its top, or 'dirs' for dirs (and files) named on the
+    command line."""
+    if layout == 'tree':
+        return [['.', None]]
+    parts = rel.split('/')
+    if len(parts) > 1:
+        return [[parts[0], None]]
+    return [] if filt.ignored(rel) else [[rel, rel]]
+
+def scan_tarfile(path, algo, filt, args):
+    """Read a tar artifact in one streaming pass, for validate_tarfile.
+    Returns (members, manifests, candidates): the (name, size, digest) of
+    each file; the text of each possible manifest; and, for each possible
+    top-level dir and layout (see guess_hash_roots), a [LegacyContentHash,
+    last sort key, [(path, hash name)]] of its files in archive order (None
+    if they turned out not to be in hash order)."""
+    members = []
+    manifests = {}
+    candidates = None
+    with open_tar_stream(path) as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            name = posixpath.normpath(member.name).lstrip('/')
+            if candidates is None:
+                tops = [''] + ([name.split('/')[0]] if '/' in name else [])
+                candidates = {(top, layout): [LegacyContentHash(algo=algo), (), []]
+                              for top in tops for layout in ('tree', 'dirs')}
+            feeding = []
+            for (top, layout), state in candidates.items():
+                if state is None:
+                    continue
+                if top and not name.startswith(top + '/'):
+                    # everything is below the top-level dir
+                    candidates[top, layout] = None
+                    continue
+                rel = archive_relpath(name, top)
+                hashed = archive_member_hash(rel, '', guess_hash_roots(rel, layout, filt), filt, args)
+                if hashed is None:
+                    continue
+                rel, key, hashname = hashed
+                key = (rel.split('/')[0],) + key[1:] if layout == 'dirs' else key
+                if key <= state[1]:
+                    candidates[top, layout] = None
+                    continue
+                state[1] = key
+                state[2].append((rel, hashname))
+                state[0].start_file(hashname)
+                feeding.append(state[0])
+            f = tf.extractfile(member)
+            sha = hashlib.new(algo)
+            is_manifest = fnmatch.fnmatch(posixpath.basename(name), "*-manifest.txt")
+            text = []
+            while 1:
+                buf = f.read(args.read_size)
+                if not buf:
+                    break
+                sha.update(buf)
+                for hasher in feeding:
+                    hasher.update(buf)
+                if is_manifest:
+                    text.append(buf)
+            members.append((name, member.size, sha.digest()))
+            if is_manifest:
+                manifests[name] = b''.join(text).decode('utf-8', 'replace')
+    return members, manifests, candidates
+
+def validate_tarfile(path, args):
+    """Validate a tar artifact without unpacking it, usually in one streaming
+    pass. The manifest (and so the top-level dir, hash roots, scheme and
+    algo) is normally the last member, so per-file digests are kept for
+    every member, and the legacy hash is computed on the fly for each
+    possible top-level dir and layout, all with the default algo. The tar is
+    read again if the manifest names another algo, or (for the legacy
+    scheme) if none of those saw the members the hash roots call for, in
+    hash order."""
+    filt = FileFilter(args, "*-manifest.txt")
+    members, manifests, candidates = scan_tarfile(path, DEFAULT_HASH_ALGO, filt, args)
+    manifest = find_archive_manifest(list(manifests))
+    if manifest is None:
+        print("No manifest found in %s; can't validate." % path)
+        return
+    values = parse_manifest(manifests[manifest])
+    algo = values.get('hash-algo', DEFAULT_HASH_ALGO)
+    if algo != DEFAULT_HASH_ALGO:
+        new_content_hash(LegacyContentHash.scheme, algo=algo) # check it's known
+        members, manifests, candidates = scan_tarfile(path, algo, filt, args)
+    top = posixpath.dirname(manifest)
+    roots = manifest_hash_roots(values)
+    hashed = [(archive_member_hash(name, top, roots, filt, args), size, digest) for name, size, digest in members]
+    hashed = sorted((m + (size, digest) for m, size, digest in hashed if m is not None), key=lambda m: m[1])
+    if 'file-count' in values and not args.full_hash:
+        actual = {rel: (size, digest.hex()) for rel, key, hashname, size, digest in hashed}
+        if not compare_file_index(parse_file_index(manifests[manifest]), actual, args):
+            sys.exit(1)
+        return
+    if 'content-hash' not in values:
+        print("Can't find hash line in manifest %s" % manifest)
+        return
+    scheme = values.get('hash-scheme', LegacyContentHash.scheme)
+    hasher = new_content_hash(scheme, algo=algo)
+    order = [(rel, hashname) for rel, key, hashname, size, digest in hashed]
+    matching = [state[0] for (cand_top, layout), state in (candidates or {}).items()
+                if cand_top == top and state is not None and state[2] == order]
+    if hasher.parallel:
+        for rel, key, hashname, size, digest in hashed:
+            hasher.add_file_digest(hashname, digest)
+    elif matching:
+        hasher = matching[0]
+    else:
+        # Not in hash order: hash the members again, in order (slow for compressed tars)
+        with tarfile.open(path, 'r:*') as tf:
+            ordered = []
+            for member in tf.getmembers():
+                m = member.isfile() and archive_member_hash(member.name, top, roots, filt, args)
+                if m:
+                    ordered.append(m + (member,))
+            ordered.sort(key=lambda m: m[1])
+            for rel, key, hashname, member in ordered:
+                hasher.start_file(hashname, rel)
+                f = tf.extractfile(member)
+                while 1:
+                    buf = f.read(args.read_size)
+                    if not buf:
+                        break
+                    hasher.update(buf)
+    check_archive_hash(values, hasher.hexdigest(), manifest)
 
+@timed_phase('validate')
 def validate_archive(args):
     """Validate that an unpacked archive has the correct hash.
-    Looks in dir specified by args.dir (not args.chdir).
+    Looks in dir specified by args.dir (not args.chdir); if that's a zip or
+    tar file, validates it directly without unpacking.
+    If the manifest has a file index, checks each file against it (unless
+    args.full_hash); otherwise rehashes the files under its hash roots with
+    the hash scheme and algo taken from the manifest (legacy and sha1 if not
+    recorded).
     Exits with status 1 if mismatch.
     """
     dir = args.dir[0]
+    if os.path.isfile(dir):
+        print("Validating archive %s" % dir)
+        if zipfile.is_zipfile(dir):
+            validate_zipfile(dir, args)
+        else:
+            validate_tarfile(dir, args)
+        return
     print("Validating archive in %s" % dir)
-    manifest = glob.glob("%s/*-manifest.txt" % dir)[0]
-    if not manifest:
+    manifests = glob.glob(os.path.join(glob.escape(dir), "*-manifest.txt"))
+    if not manifests:
         print("No manifest found in %s; can't validate." % dir)
         return
-    manifest_contents = open(manifest, 'rb').read(1024*1024).splitlines()
-    hashline = [x for x in manifest_contents if x.startswith("content-hash: ")]
-    if hashline == []:
+    manifest = manifests[0]
+    values = read_manifest(manifest)
+    args.hash_algo = values.get('hash-algo', DEFAULT_HASH_ALGO)
+    if 'file-count' in values and not args.full_hash:
+        if not validate_file_index(dir, manifest, args):
+            sys.exit(1)
+        return
+    if 'content-hash' not in values:
         print("Can't find hash line in manifest %s" % manifest)
         return
-    key, expected = hashline[0].split(': ')
-    hash = hash_dir_contents(dir, ignore_pattern="*-manifest.txt", args=args)
-    if hash != expected:
-        print("Hash mismatch: actual %s, expected %s" % (hash, expected))
-        sys.exit(1)
-    print("Hash OK: %s."%hash)
+    args.hash_scheme = values.get('hash-scheme', LegacyContentHash.scheme)
+    args.hash_algo = values.get('hash-algo', DEFAULT_HASH_ALGO)
+    files = []
+    for root, hashname in manifest_hash_roots(values):
+        path = os.path.join(dir, *root.split('/'))
+        if hashname is None:
+            if os.path.isdir(path):
+                files.extend(collect_artifact_files(path, "*-manifest.txt", "", args))
+        elif os.path.isfile(path):
+            files.append(ArtifactFile(path, hashname, root, os.stat(path)))
+    hash = hash_dir_contents(dir, ignore_pattern="*-manifest.txt", args=args, files=files)
+    check_archive_hash(values, hash, manifest)
+
+def write_member(f, path, mode, algo, read_size):
+    """Write an archive member's contents (file object f) to path, creating
+    parent dirs, and hash it on the way; mode is its permission bits (0 to
+    leave the default). Returns (size, digest)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sha = hashlib.new(algo)
+    size = 0
+    with open(path, 'wb') as out:
+        while 1:
+            buf = f.read(read_size)
+            if not buf:
+                break
+            sha.update(buf)
+            out.write(buf)
+            size += len(buf)
+    if mode:
+        os.chmod(path, mode)
+    return size, sha.digest()
+
+def extract_zip_members(path, infos, staging, top, algo, read_size):
+    """Unpack some zip members into staging, on a worker thread with its own
+    handle on the zip. Returns [(member name, size, digest)]."""
+    written = []
+    with zipfile.ZipFile(path) as zf:
+        for info in infos:
+            with zf.open(info) as f:
+                size, digest = write_member(f, member_path(staging, info.filename, top),
+                                            (info.external_attr >> 16) & 0o777, algo, read_size)
+            written.append((info.filename, size, digest))
+    return written
+
+@timed_phase('extract')
+def extract_artifact(args):
+    """Unpack the artifact args.extract into the dir args.to, checking it
+    against its manifest as it goes: every file is hashed as it's written
+    (zip members are decompressed on args.jobs threads; a tar is streamed
+    on one). Everything is written to a staging dir next to args.to, which
+    is renamed to args.to only if the content hash (or the file index)
+    matches, so a failed check never leaves a partial tree behind.
+    The legacy scheme can't combine per-file digests, so its hash is
+    computed by reading the freshly written files back in walk order.
+    Exits with status 1 on a mismatch."""
+    path, dest = args.extract, os.path.abspath(args.to)
+    if os.path.exists(dest) and (not os.path.isdir(dest) or os.listdir(dest)):
+        raise RuntimeError("Can't extract to %s: it already exists" % dest)
+    print("Extracting %s to %s" % (path, dest))
+    staging = tempfile.mkdtemp(prefix='.%s.' % os.path.basename(dest), suffix='.tmp',
+                               dir=os.path.dirname(dest))
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                infos = [info for info in zf.infolist() if not info.is_dir()]
+                manifest = find_archive_manifest([info.filename for info in infos])
+                if manifest is None:
+                    raise RuntimeError("No manifest found in %s; can't extract it." % path)
+                text = zf.read(manifest).decode('utf-8', 'replace')
+            values = parse_manifest(text)
+            top = posixpath.dirname(manifest)
+            algo = values.get('hash-algo', DEFAULT_HASH_ALGO)
+            new_content_hash(LegacyContentHash.scheme, algo=algo) # check it's known
+            # share the members out by size, biggest first, to the least loaded worker
+            jobs = max(1, min(args.jobs, len(infos)))
+            shares = [[0, []] for i in range(jobs)]
+            for info in sorted(infos, key=lambda info: -info.file_size):
+                share = min(shares, key=lambda share: share[0])
+                share[0] += info.file_size
+                share[1].append(info)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(extract_zip_members, path, share[1], staging, top, algo, args.read_size)
+                           for share in shares]
+                written = [member for future in futures for member in future.result()]
+        else:
+            written = []
+            with open_tar_stream(path) as tf:
+                for member in tf:
+                    if member.isdir():
+                        os.makedirs(member_path(staging, member.name, ''), exist_ok=True)
+                    elif member.isfile():
+                        # the top dir isn't known until the manifest turns up; unpack as is
+                        size, digest = write_member(tf.extractfile(member), member_path(staging, member.name, ''),
+                                                    member.mode & 0o777, DEFAULT_HASH_ALGO, args.read_size)
+                        written.append((member.name, size, digest))
+            manifest = find_archive_manifest([posixpath.normpath(name).lstrip('/') for name, size, digest in written])
+            if manifest is None:
+                raise RuntimeError("No manifest found in %s; can't extract it." % path)
+            with open(member_path(staging, manifest, ''), 'rb') as f:
+                text = f.read().decode('utf-8', 'replace')
+            values = parse_manifest(text)
+            top = posixpath.dirname(manifest)
+            algo = values.get('hash-algo', DEFAULT_HASH_ALGO)
+            new_content_hash(LegacyContentHash.scheme, algo=algo) # check it's known
+            if top:
+                # move the top dir's contents up, into the staging dir itself
+                topdir = member_path(staging, top, '')
+                for entry in os.listdir(topdir):
+                    os.rename(os.path.join(topdir, entry), os.path.join(staging, entry))
+                os.rmdir(topdir)
+            if algo != DEFAULT_HASH_ALGO:
+                written = [(name, size, hash_file(member_path(staging, name, top), algo, args))
+                           for name, size, digest in written]
+        filt = FileFilter(args, "*-manifest.txt")
+        roots = manifest_hash_roots(values)
+        hashed = [(archive_member_hash(name, top, roots, filt, args), size, digest) for name, size, digest in written]
+        hashed = sorted((m + (size, digest) for m, size, digest in hashed if m is not None), key=lambda m: m[1])
+        if 'file-count' in values and not args.full_hash:
+            actual = {rel: (size, digest.hex()) for rel, key, hashname, size, digest in hashed}
+            if not compare_file_index(parse_file_index(text), actual, args):
+                sys.exit(1)
+        elif 'content-hash' not in values:
+            raise RuntimeError("Can't find hash line in manifest %s" % manifest)
+        else:
+            hasher = new_content_hash(values.get('hash-scheme', LegacyContentHash.scheme), algo=algo)
+            for rel, key, hashname, size, digest in hashed:
+                if hasher.parallel:
+                    hasher.add_file_digest(hashname, digest)
+                else:
+                    hasher.start_file(hashname, rel)
+                    feed_file(member_path(staging, rel, ''), hasher.update, args)
+                    hasher.end_file()
+            check_archive_hash(values, hasher.hexdigest(), manifest)
+        os.replace(staging, dest)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    print("Extracted %d files to %s" % (len(written), dest))
+
+def archive_relpath(name, top):
+    """An archive member's path relative to the top-level dir top, as in the
+    member index (and the unpacked tree)."""
+    name = posixpath.normpath(name).lstrip('/')
+    return name[len(top) + 1:] if top and name.startswith(top + '/') else name
+
+def tar_member_index(f, members, top, index):
+    """Return the member index entries {path: [data offset, size, size, digest]}
+    of a tar's files, from the (header offset, tarinfo) list of what was
+    added to the tarfile f; offsets are in the uncompressed tar."""
+    digests = {path: digest.hex() for path, size, digest in index}
+    entries = {}
+    for offset, tinfo in members:
+        if tinfo.isfile():
+            path = archive_relpath(tinfo.name, top)
+            offset += len(tinfo.tobuf(f.format, f.encoding, f.errors))
+            entries[path] = [offset, tinfo.size, tinfo.size, digests.get(path)]
+    return entries
+
+def write_member_index(filename, format, top, entries, blocks, args):
+    """Write the --member-index sidecar for the artifact file filename: for
+    each member path, its offset, compressed size, size and digest (and zip
+    compression method). For a block-gzipped tar, offsets are in the
+    uncompressed tar, and blocks maps them to the compressed file."""
+    index = {'version': 1, 'artifact': os.path.basename(filename), 'size': os.path.getsize(filename),
+             'format': format, 'codec': args.tar_codec if format == 'tar' else None,
+             'hash-algo': args.hash_algo, 'top-dir': top, 'blocks': blocks, 'members': entries}
+    write_atomically(filename + '.idx', lambda f: f.write(json.dumps(index, separators=(',', ':')).encode('utf-8')))
+
+def read_zip_member_at(f, offset, compress_size, method, read_size):
+    """Yield the contents of the zip entry whose local header is at offset in f."""
+    f.seek(offset)
+    header = f.read(ZIP_LOCAL_HEADER_SIZE)
+    if header[:4] != b'PK\x03\x04':
+        raise RuntimeError("Stale member index: no zip entry at offset %d" % offset)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    f.seek(name_len + extra_len, os.SEEK_CUR)
+    if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise RuntimeError("Unsupported zip compression method %d" % method)
+    decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    left = compress_size
+    while left:
+        buf = f.read(min(read_size, left))
+        if not buf:
+            raise RuntimeError("Zip entry at offset %d is truncated" % offset)
+        left -= len(buf)
+        yield decompressor.decompress(buf) if decompressor else buf
+    if decompressor:
+        yield decompressor.flush()
+
+def read_gzip_blocks_at(f, raw_offset, skip, size, read_size):
+    """Yield size bytes of the uncompressed data of a multi-member gzip file
+    f, starting skip bytes into the gzip member at raw_offset."""
+    f.seek(raw_offset)
+    decompressor = zlib.decompressobj(31)
+    while size:
+        buf = f.read(read_size)
+        if not buf:
+            raise RuntimeError("Gzip data at offset %d is truncated" % raw_offset)
+        while buf and size:
+            out = decompressor.decompress(buf)
+            buf = b''
+            if decompressor.eof:
+                buf = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+            if skip:
+                n = min(skip, len(out))
+                out = out[n:]
+                skip -= n
+            out = out[:size]
+            size -= len(out)
+            if out:
+                yield out
+
+def read_indexed_member(path, index, entry, read_size):
+    """Yield the contents of an artifact member from its member index entry,
+    seeking straight to it where the format allows."""
+    with open(path, 'rb') as f:
+        if index['format'] == 'zip':
+            offset, compress_size, size, digest, method = entry
+            yield from read_zip_member_at(f, offset, compress_size, method, read_size)
+        elif index['blocks']:
+            offset, compress_size, size, digest = entry
+            starts = [start for raw, start in index['blocks']]
+            raw, start = index['blocks'][bisect.bisect_right(starts, offset) - 1]
+            yield from read_gzip_blocks_at(f, raw, offset - start, size, read_size)
+        else:
+            # for bz2 and xz, there's no random access: seeking decompresses up to it
+            offset, compress_size, size, digest = entry
+            with open_decompressor(f, index['codec']) as src:
+                src.seek(offset)
+                while size:
+                    buf = src.read(min(read_size, size))
+                    if not buf:
+                        raise RuntimeError("Tar member at offset %d is truncated" % offset)
+                    size -= len(buf)
+                    yield buf
+
+def manifest_member_digest(text, member):
+    """Return (hex digest or None, hash algo) of member in the manifest text's file index."""
+    algo = parse_manifest(text).get('hash-algo', DEFAULT_HASH_ALGO)
+    return parse_file_index(text).get(member, (None, None))[1], algo
+
+def read_scanned_member(path, member, read_size):
+    """Yield first the expected (hex digest, hash algo) of an artifact member
+    (a path relative to the top-level dir) from the manifest's file index
+    (the digest is None without one), then its contents. For use without a
+    member index: a zip is opened directly, while a tar is scanned, keeping
+    possible matches in temp files until its manifest (which comes last)
+    shows which dir is the top-level one."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            names = [info.filename for info in zf.infolist() if not info.is_dir()]
+            manifest = find_archive_manifest(names)
+            top = posixpath.dirname(manifest) if manifest else ''
+            text = zf.read(manifest).decode('utf-8', 'replace') if manifest else ''
+            for name in names:
+                if archive_relpath(name, top) == member:
+                    yield manifest_member_digest(text, member)
+                    with zf.open(name) as f:
+                        yield from iter(lambda: f.read(read_size), b'')
+                    return
+        raise RuntimeError("No member %s in %s" % (member, path))
+    names = []
+    manifests = {}
+    candidates = {}     # name: temp file with its contents
+    try:
+        with open_tar_stream(path) as tf:
+            for tinfo in tf:
+                if not tinfo.isfile():
+                    continue
+                name = posixpath.normpath(tinfo.name).lstrip('/')
+                names.append(name)
+                f = tf.extractfile(tinfo)
+                if fnmatch.fnmatch(posixpath.basename(name), "*-manifest.txt"):
+                    data = f.read()
+                    manifests[name] = data.decode('utf-8', 'replace')
+                    f = io.BytesIO(data)
+                if name == member or name.endswith('/' + member):
+                    candidates[name] = tempfile.TemporaryFile()
+                    shutil.copyfileobj(f, candidates[name], read_size)
+        manifest = find_archive_manifest(names)
+        top = posixpath.dirname(manifest) if manifest else ''
+        name = posixpath.join(top, member) if top else member
+        if name not in candidates:
+            raise RuntimeError("No member %s in %s" % (member, path))
+        yield manifest_member_digest(manifests.get(manifest, ''), member)
+        f = candidates[name]
+        f.seek(0)
+        yield from iter(lambda: f.read(read_size), b'')
+    finally:
+        for f in candidates.values():
+            f.close()
+
+@timed_phase('extract')
+def extract_member(args):
+    """Extract the single member args.extract_member (a path in the unpacked
+    artifact) of the artifact args.dir[0], using its --member-index
+    sidecar (<artifact>.idx) to seek straight to it, and check its digest.
+    Writes it under args.to (keeping its path), or to stdout; a file is
+    only put in place if it checks out, while on stdout a mismatch is
+    reported at the end. Without an index, the archive is scanned, and the
+    member checked against the manifest's file index if it has one.
+    Exits with status 1 on a mismatch."""
+    path = args.dir[0]
+    member = posixpath.normpath(args.extract_member.replace('\\', '/')).lstrip('/')
+    index = None
+    if os.path.exists(path + '.idx'):
+        with open(path + '.idx', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('size') != os.path.getsize(path):
+            logging.warning("Warning: member index %s.idx doesn't match %s; ignoring it." % (path, path))
+            index = None
+    if index is not None:
+        if member not in index['members']:
+            raise RuntimeError("No member %s in %s" % (member, path))
+        entry = index['members'][member]
+        expected, algo = entry[3], index['hash-algo']
+        chunks = read_indexed_member(path, index, entry, args.read_size)
+    else:
+        logging.warning("Warning: no member index for %s; scanning it." % path)
+        chunks = read_scanned_member(path, member, args.read_size)
+        expected, algo = next(chunks)
+    sha = hashlib.new(algo)
+    if args.to:
+        dest = member_path(args.to, member, '')
+        tmpdest = '%s.%d.tmp' % (dest, os.getpid())
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        out = open(tmpdest, 'wb')
+    else:
+        out = sys.stdout.buffer
+    try:
+        for buf in chunks:
+            sha.update(buf)
+            out.write(buf)
+        out.flush()
+        if expected is not None and sha.hexdigest() != expected:
+            sys.stderr.write("Digest mismatch for %s: actual %s, expected %s\n" % (member, sha.hexdigest(), expected))
+            sys.exit(1)
+        if args.to:
+            out.close()
+            os.replace(tmpdest, dest)
+            print("Extracted %s to %s (%s)" % (member, dest, "digest OK" if expected else "not checked"))
+    finally:
+        if args.to:
+            out.close()
+            if os.path.exists(tmpdest):
+                os.unlink(tmpdest)
 
+@timed_phase('git')
 def cmd(cmd, name, cwd=None):
     """Run shell command; if it fails, return None."""
     try:
@@ -285,14 +2724,285 @@ def cmd(cmd, name, cwd=None):
         # Don't print here; wait to see if user specifies it on cmd line
         return None
 
+@functools.lru_cache(maxsize=None)
+def machine_metadata():
+    """Return the manifest fields that describe this machine and build, as
+    {arg name: value}. Computed once per process, so every artifact built in
+    it shares them (including the build date)."""
+    uname = platform.uname()
+    return {'build_date': time.ctime(),
+            'build_machine': socket.gethostname(),
+            'os': uname[0],
+            'build_os': ' '.join([uname[i] for i in (0,2,3,4)]),
+            'author': getpass.getuser()}
 
-def main(argv=None):
+def find_git_root(dir):
+    """Return the nearest dir at or above dir containing .git, or None."""
+    dir = os.path.abspath(dir)
+    while not os.path.exists(os.path.join(dir, '.git')):
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+    return dir
+
+@functools.lru_cache(maxsize=None)
+def git_metadata(dir):
+    """Return (branch, short SHA) of the git checkout at dir; either may be None.
+    Cached, so artifacts from the same checkout only run git once. Both come
+    from a single git command."""
+    out = cmd("git rev-parse HEAD --abbrev-ref HEAD", 'build-branch and build-id', dir)
+    branch = id = None
+    if out is not None and len(out.split()) == 2:
+        id, branch = out.split()
+        id = id[:10]
+    return branch, id
+
+@timed_phase('metadata')
+def fill_metadata(args, names_only=False):
+    """Fill in the manifest fields left as None with the shared machine
+    metadata, and the build branch and id from git. With names_only, just
+    fill in what the artifact's name needs (the build id), without probing
+    the machine."""
+    if not names_only:
+        for key, value in machine_metadata().items():
+            if getattr(args, key) is None:
+                setattr(args, key, value)
+    if args.build_id is not None and (names_only or args.build_branch is not None):
+        return
+    if args.chdir is None:
+        dir = args.dir[0]
+    else:
+        dir = os.path.join(args.chdir, args.dir[0])
+    branch, id = git_metadata(find_git_root(dir) or os.path.abspath(dir))
+    if args.build_branch is None and not names_only:
+        if branch is None:
+            logging.warning("Warning: Can't get default value for --build-branch; using None.")
+        args.build_branch = branch
+    if args.build_id is None:
+        if id is None:
+            logging.warning("Warning: Can't get default value for --build-id; using 1.")
+        args.build_id = id if id is not None else 1
+
+def prepare_args(args, metadata=True):
+    """Finish a config (parsed args) before use: make paths that must not
+    follow --chdir absolute, and (if metadata) fill in the metadata defaults."""
+    if args.hash_cache:
+        args.hash_cache = os.path.abspath(args.hash_cache) # before any --chdir
+    if args.manifest_out:
+        args.manifest_out = os.path.abspath(args.manifest_out)
+    if args.delta_from:
+        args.delta_from = os.path.abspath(args.delta_from)
+    if args.store:
+        args.store = os.path.abspath(args.store)
+    if metadata:
+        fill_metadata(args)
+
+class ArtifactBuilder:
+    """Build artifacts in-process, without starting an interpreter and
+    parsing a command line for each one. Keyword options are the
+    command-line options' attribute names (dir, name, base_version, tar,
+    outdir, hash_scheme, ...); those given to the builder apply to every
+    artifact it builds. Machine and git metadata are computed once and
+    shared. E.g.:
+
+        builder = ArtifactBuilder(outdir='dist', silent=True)
+        result = builder.build(['bin'], 'foo', '1.0', tar=True)
+        results = builder.build_all([{'dir': ['lib'], 'name': 'bar', 'base_version': '2.0'}])
+    """
+    def __init__(self, **options):
+        self.parser = make_parser()
+        self.defaults = {action.dest: action.default for action in self.parser._actions
+                         if action.default is not argparse.SUPPRESS}
+        self.options = options
+        for key in options:
+            if key not in self.defaults:
+                raise TypeError("Unknown artifact option '%s'" % key)
+
+    def config(self, **options):
+        """Return the config (an argparse.Namespace, as from the command line)
+        for one artifact with these options, on top of the builder's."""
+        config = dict(self.defaults, **self.options)
+        for key, value in options.items():
+            if key not in config:
+                raise TypeError("Unknown artifact option '%s'" % key)
+            config[key] = value
+        if isinstance(config['dir'], str):
+            config['dir'] = [config['dir']]
+        for key in ('dir', 'name', 'base_version'):
+            if config[key] is None:
+                raise TypeError("Artifact option '%s' is required" % key)
+        if config['tar_level'] is not None and config['tar_level'] not in TAR_CODECS[config['tar_codec']][2]:
+            raise ValueError("Artifact option tar_level=%d isn't valid for tar_codec %s"
+                             % (config['tar_level'], config['tar_codec']))
+        args = argparse.Namespace(**config)
+        prepare_args(args)
+        return args
+
+    def build(self, dir, name, base_version, **options):
+        """Build one artifact from dir (a path or list of paths); returns an ArtifactResult."""
+        return create_artifact(self.config(dir=dir, name=name, base_version=base_version, **options))
+
+    def build_all(self, specs):
+        """Build each artifact in specs, a list of dicts of options (each with
+        at least dir, name and base_version); returns a list of ArtifactResults."""
+        return [self.build(**spec) for spec in specs]
+
+def build_artifact(dir, name, base_version, **options):
+    """Build one artifact in-process; see ArtifactBuilder. Returns an ArtifactResult."""
+    return ArtifactBuilder().build(dir, name, base_version, **options)
+
+def load_batch_specs(path):
+    """Read a --batch spec file: TOML if it ends in .toml (needs Python 3.11+),
+    otherwise JSON. It's either a list of artifact specs, or a table with the
+    specs in a list called "artifact" (or "artifacts") and optional
+    "defaults" for all of them. Keys are option names, with - or _
+    (base-version or base_version). Returns a list of option dicts."""
+    try:
+        if path.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                raise RuntimeError("Reading %s needs Python 3.11 or later; use a JSON spec file instead" % path)
+            with open(path, 'rb') as f:
+                data = tomllib.load(f)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuntimeError("Can't read batch file %s: %s" % (path, e))
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get('defaults', {})
+        data = data.get('artifact', data.get('artifacts', []))
+    specs = []
+    for spec in data:
+        options = {key.replace('-', '_'): value for key, value in defaults.items()}
+        options.update({key.replace('-', '_'): value for key, value in spec.items()})
+        for key in ('dir', 'exclude', 'include'):
+            if isinstance(options.get(key), str):
+                options[key] = [options[key]]
+        specs.append(options)
+    return specs
+
+def share_batch_digests(configs):
+    """Hash each file that's in more than one tree-v1 artifact of a batch just
+    once, up front, into a hash cache the builds then share: they still read
+    the files to archive them, but don't hash them again. (The legacy scheme
+    hashes each tree sequentially, so it can't share digests.)
+    The cache is the configs' --hash-cache, or a temp file for the batch.
+    Returns the temp dir to remove after the batch, or None."""
+    configs = [c for c in configs if c.hash_scheme == TreeContentHash.scheme and not c.no_hash_cache]
+    if len(set(c.hash_cache for c in configs)) != 1:
+        return None             # nothing to share, or separate caches
+    counts = collections.Counter()
+    file_stats = {}
+    for config in configs:
+        # paths are relative to the config's --chdir
+        base = config.chdir or '.'
+        options = argparse.Namespace(**dict(vars(config), include=[os.path.join(base, f) for f in config.include]))
+        try:
+            files = collect_artifact_files([os.path.join(base, d) for d in config.dir],
+                                           "*-manifest.txt", "", options)
+        except (OSError, RuntimeError):
+            continue            # its build will fail and say why
+        for file in files:
+            if file.hashname is not None:
+                key = (os.path.abspath(file.filepath), config.hash_algo)
+                counts[key] += 1
+                file_stats[key] = file.st
+    shared = [key + (file_stats[key],) for key, count in counts.items() if count > 1]
+    if not shared:
+        return None
+    tmpdir = None
+    path = configs[0].hash_cache
+    if path is None:
+        tmpdir = tempfile.mkdtemp(prefix='binary-artifact-batch')
+        path = os.path.join(tmpdir, 'hash-cache.json')
+        for config in configs:
+            config.hash_cache = path
+    cache = HashCache(path, configs[0].hash_cache_size)
+    to_hash = [(filepath, algo, st) for filepath, algo, st in shared
+               if cache.lookup(filepath, st, algo) is None]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=configs[0].jobs) as pool:
+        digests = pool.map(lambda key: hash_file(key[0], key[1], configs[0]), to_hash)
+        for (filepath, algo, st), digest in zip(to_hash, digests):
+            cache.store(filepath, st, algo, digest)
+    cache.save()
+    return tmpdir
+
+def build_batch_artifact(config):
+    """Build one artifact of a batch, in a worker process; returns (ArtifactResult, seconds)."""
+    start = time.perf_counter()
+    result = create_artifact(config)
+    return result, time.perf_counter() - start
+
+def print_batch_summary(configs, results, seconds):
+    """Print a table of each batch artifact's build time, source bytes read and size."""
+    rows = []
+    for config, result in zip(configs, results):
+        if result is None:
+            rows.append((config.name, 'FAILED', '', ''))
+            continue
+        result, build_seconds = result
+        size = os.path.getsize(result.path) if result.path else 0
+        rows.append((os.path.basename(result.path) if result.path else result.name,
+                     '%.2f' % build_seconds, str(result.bytes_read), str(size)))
+    rows.append(('total (wall time)', '%.2f' % seconds,
+                 str(sum(r[0].bytes_read for r in results if r is not None)),
+                 str(sum(int(row[3]) for row in rows if row[3]))))
+    width = max(len(row[0]) for row in rows)
+    print("%-*s %10s %14s %14s" % (width, 'artifact', 'seconds', 'bytes read', 'size'))
+    for row in rows:
+        print("%-*s %10s %14s %14s" % ((width,) + row))
+
+def run_batch(args, parser):
+    """Build every artifact in the args.batch spec file, up to args.batch_jobs
+    at a time in separate processes, then print a summary table. Options
+    given on the command line apply to every artifact (the spec file's
+    options take precedence). Returns the exit status."""
+    start = time.perf_counter()
+    options = {dest: value for dest, value in vars(args).items()
+               if dest not in ('batch', 'batch_jobs', 'dir', 'name', 'base_version')
+               and value != parser.get_default(dest)}
+    options.setdefault('silent', True) # manifests from parallel builds would interleave
+    builder = ArtifactBuilder(**options)
+    configs = [builder.config(**spec) for spec in load_batch_specs(args.batch)]
+    tmpdir = share_batch_digests(configs)
+    results = [None] * len(configs)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.batch_jobs) as pool:
+            futures = {pool.submit(build_batch_artifact, config): i for i, config in enumerate(configs)}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    print("Failed to build %s: %s" % (configs[i].name, e))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    print_batch_summary(configs, results, time.perf_counter() - start)
+    return 1 if None in results else 0
+
+def number_at_least(minimum, type=int):
+    """Return an argparse type for numbers (ints, or floats) no smaller than minimum."""
+    def parse(value):
+        n = type(value)
+        if n < minimum:
+            raise argparse.ArgumentTypeError("must be at least %s, not %s" % (minimum, n))
+        return n
+    parse.__name__ = type.__name__   # for argparse's "invalid int value" message
+    return parse
+
+def make_parser():
+    """Return the command-line parser. Its defaults are also the defaults
+    for ArtifactBuilder options."""
     class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
                           argparse.RawDescriptionHelpFormatter):
         pass
 
-    try:
-        parser = argparse.ArgumentParser(description="""Binary Artifact builder
+    parser = argparse.ArgumentParser(description="""Binary Artifact builder
     Make a zip/tarfile called NAME-VER-BUILD-DATE-HASH.tgz from all the files in dirs.
         Include a generated manifest, so the result looks like:
         filename: NAME-VER-BUILD-DATE-HASH.tgz/.zip
@@ -302,103 +3012,270 @@ def main(argv=None):
             dir1/
             dir2/
               ...""",
-                                         formatter_class=CustomFormatter)
-        parser.add_argument('--base-version', '-B', required=True,
-                            help="""Base version for manifest""")
-        parser.add_argument('--name', '-n', required=True,
-                            help="""Artifact name (human readable). E.g. 'libfoo-mac'.""")
-        parser.add_argument('--bits', '-b', type=int, default=64,
-                            help="""bits (32 or 64)""")
-        parser.add_argument('--build-id', '-i',
-                            default=None,
-                            help="""Build ID (default: dynamic, based on git SHA of dir)""")
-        parser.add_argument('--build-branch', '--branch',
-                            default=None,
-                            help="""Build branch (default: dynamic, based on git branch of dir)""")
-        parser.add_argument('--build-date', '--date', '-D',
-                            default=time.ctime(),
-                            help="""Build date""")
-        parser.add_argument('--build-machine', '--machine', '-m',
-                            default=socket.gethostname(),
-                            help="""Build machine""")
-        parser.add_argument('--os', '-o',
-                            default=platform.uname()[0],
-                            help="""Build machine OS""")
-        parser.add_argument('--build-os', '-O',
-                            default=' '.join([platform.uname()[i] for i in (0,2,3,4)]),
-                            help="""Build machine OS""")
-        parser.add_argument('--note', '-N',
-                            help="""Note to put in manifest (one line)""")
-        parser.add_argument('--author', '-a',
-                            default=getpass.getuser(),
-                            help="""Person (username/email) building the archive""")
-        parser.add_argument('--chdir', '-C',
-                            help="""Change to this dir before starting to archive files.\n"""
-                            """Useful if dir is in a subdir or elsewhere on disk and you don't\n"""
-                            """want the intervening dir names in the final archive.""")
-        parser.add_argument('--outdir',
-                            default='.',
-                            help="""Directory in which to create the output zip/tar file.""")
-        parser.add_argument('--silent', '-s', action='store_true',
-                            help="""Skip printing the manifest file contents on stdout""")
-        parser.add_argument('--tar', '-T', action='store_true',
-                            help="""Create a tar (tgz) file instead of zip""")
-        parser.add_argument('--name-only', action='store_true',
-                            help="""Don't build the archive; just return the name of the tar/zip file. (Requires hashing contents.)""")
-        parser.add_argument('--hash-only', action='store_true',
-                            help="""Don't build the archive; just return the hash of the given dir.""")
-        parser.add_argument('--validate', action='store_true',
-                            help="""Validate an unpacked archive by checking its hash against the manifest.""")
-        parser.add_argument('--exclude', action='append', default=[],
-                            help="""Exclude this filename from the archive. May be repeated.""")
-        parser.add_argument('--include', action='append', default=[],
-                            help="""Include this filename in the archive as if it existed in the first source dir. May be repeated.""")
-        parser.add_argument('dir', nargs='+',
-                            help="""dirs to collect into the binary artifact""")
-        parser.add_argument('--top-dir-name', '-t',
-                            default=None,
-                            help="""Top dir of the resulting zip:\n"""
-                            """\tDefault=None means use the full name of the zip."""
-                            """\tA string means use that name as the top dir."""
-                            """\t'.' means no top dir; put the manifest and contents at top level.""")
-        parser.add_argument('--no-recurse',
-                            action='store_true',
-                            help="""Don't recurse into subdirs of the dirs passed on the command line; only include files directly in those dirs.""")
-        parser.add_argument('--include-hidden',
-                            action='store_true',
-                            help="""Include "hidden" files and dirs beginning with "." (e.g. .git).""")
-        parser.add_argument('--verbose',
-                            action='store_true',
-                            help="""Be more verbose about processing individual files and dirs.""")
-        args = parser.parse_args(argv)
+                                     formatter_class=CustomFormatter)
+    parser.add_argument('--base-version', '-B',
+                        help="""Base version for manifest (required unless --batch)""")
+    parser.add_argument('--name', '-n',
+                        help="""Artifact name (human readable). E.g. 'libfoo-mac'. Required unless --batch.""")
+    parser.add_argument('--bits', '-b', type=int, default=64,
+                        help="""bits (32 or 64)""")
+    parser.add_argument('--build-id', '-i',
+                        default=None,
+                        help="""Build ID (default: dynamic, based on git SHA of dir)""")
+    parser.add_argument('--build-branch', '--branch',
+                        default=None,
+                        help="""Build branch (default: dynamic, based on git branch of dir)""")
+    parser.add_argument('--build-date', '--date', '-D',
+                        default=None,
+                        help="""Build date (default: now)""")
+    parser.add_argument('--build-machine', '--machine', '-m',
+                        default=None,
+                        help="""Build machine (default: this machine's name)""")
+    parser.add_argument('--os', '-o',
+                        default=None,
+                        help="""Build machine OS (default: this machine's OS)""")
+    parser.add_argument('--build-os', '-O',
+                        default=None,
+                        help="""Build machine OS (default: this machine's OS, release, version and arch)""")
+    parser.add_argument('--note', '-N',
+                        help="""Note to put in manifest (one line)""")
+    parser.add_argument('--author', '-a',
+                        default=None,
+                        help="""Person (username/email) building the archive (default: current user)""")
+    parser.add_argument('--chdir', '-C',
+                        help="""Change to this dir before starting to archive files.\n"""
+                        """Useful if dir is in a subdir or elsewhere on disk and you don't\n"""
+                        """want the intervening dir names in the final archive.""")
+    parser.add_argument('--outdir',
+                        default='.',
+                        help="""Directory in which to create the output zip/tar file.""")
+    parser.add_argument('--output',
+                        help="""Stream the artifact to this file or pipe instead of creating it in --outdir;\n"""
+                        """'-' means stdout (the manifest then goes to stderr). Uses bounded memory\n"""
+                        """and never seeks, but if the top dir is named after the artifact the files\n"""
+                        """have to be hashed before they're archived.""")
+    parser.add_argument('--delta-from', metavar='BASE',
+                        help="""Make a delta artifact (<name>-delta.zip/.tgz) holding only the files added or\n"""
+                        """changed since the base artifact file BASE (compared by per-file digest), plus a\n"""
+                        """manifest listing the removed ones. Fastest if BASE was built with --file-index.""")
+    parser.add_argument('--apply-delta', metavar='DELTA',
+                        help="""Apply the delta artifact DELTA to the unpacked base artifact in dir, then\n"""
+                        """validate the result as with --validate.""")
+    parser.add_argument('--store', metavar='DIR',
+                        help="""Put the artifact in the content-addressed store DIR instead of making an archive:\n"""
+                        """each distinct file is stored once, by digest, and the artifact is a small index.""")
+    parser.add_argument('--store-cmd', choices=('ls', 'du', 'gc', 'rm', 'export'),
+                        help="""Run a command on the --store: ls (list artifacts), du (space used and saved),\n"""
+                        """gc (delete unreferenced blobs), rm (remove the artifacts named by the dir args,\n"""
+                        """then gc) or export (write the named artifacts to --outdir as zip/tar files).""")
+    parser.add_argument('--extract', metavar='ARTIFACT',
+                        help="""Unpack the zip or tar ARTIFACT into the dir given by --to, checking every file\n"""
+                        """against the manifest as it's written (zips on --jobs threads). The tree is unpacked\n"""
+                        """into a staging dir and only renamed to --to if it validates.""")
+    parser.add_argument('--to', metavar='DIR',
+                        help="""Where --extract puts the artifact's contents (the top-level dir's, if it has one).""")
+    parser.add_argument('--stats', action='store_true',
+                        help="""Report wall and CPU time per phase (walk, hash, archive, compress, git, ...),\n"""
+                        """files and bytes read and written, and the slowest files, on stderr.""")
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help="""Like --stats, but write the report to FILE as JSON.""")
+    parser.add_argument('--stats-top', type=int, default=10, metavar='N',
+                        help="""Number of slowest files for --stats to list.""")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="""Run under cProfile and write the profile to FILE (for python -m pstats).""")
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help="""Run as a daemon on the Unix socket SOCKET, answering --hash-only and --name-only\n"""
+                        """queries from --server clients. It keeps per-file digests in memory, polls the trees\n"""
+                        """it's been asked about, and rehashes only files that changed (with --hash-scheme\n"""
+                        """tree-v1; legacy has no per-file digests, so any change rereads the whole tree).""")
+    parser.add_argument('--server', metavar='SOCKET', default=os.environ.get('BINARY_ARTIFACT_SERVER'),
+                        help="""For --hash-only and --name-only, ask the --serve daemon on SOCKET for the hash,\n"""
+                        """hashing the files directly if it isn't running. Default: $BINARY_ARTIFACT_SERVER.""")
+    parser.add_argument('--poll-interval', type=number_at_least(0, float), default=30.0, metavar='SECONDS',
+                        help="""How often --serve checks the trees it knows for changes in the background\n"""
+                        """(0 for never; queries always check).""")
+    parser.add_argument('--idle-expiry', type=number_at_least(0, float), default=600.0, metavar='SECONDS',
+                        help="""Forget a --serve tree (stop polling it) after this long without a query.""")
+    parser.add_argument('--member-index', action='store_true',
+                        help="""Also write <artifact>.idx, a sidecar index of each member's offset, sizes and\n"""
+                        """digest, for --extract-member. A gz tar is then compressed in independent blocks\n"""
+                        """(see --gzip-block-size) so any member can be reached without decompressing\n"""
+                        """everything before it.""")
+    parser.add_argument('--gzip-block-size', type=number_at_least(1), default=1 << 20, metavar='BYTES',
+                        help="""With --member-index, start a new gzip block every this many bytes of tar.""")
+    parser.add_argument('--extract-member', metavar='PATH',
+                        help="""Extract just the member PATH (as in the unpacked artifact) of the artifact given\n"""
+                        """as dir, to stdout or under --to, checking its digest. Uses the --member-index\n"""
+                        """sidecar to seek straight to it if there is one.""")
+    parser.add_argument('--reuse-existing', action='store_true',
+                        help="""Hash the files first, and if --outdir already has an artifact with the same name,\n"""
+                        """base version and hash, copy it under the new name with a fresh manifest instead of\n"""
+                        """archiving the files again. Best with tree-v1 and a hash cache, since otherwise\n"""
+                        """the files are read twice when there's nothing to reuse.""")
+    parser.add_argument('--manifest-out',
+                        help="""Also write the manifest to this file (useful with --output).""")
+    parser.add_argument('--silent', '-s', action='store_true',
+                        help="""Skip printing the manifest file contents on stdout""")
+    parser.add_argument('--tar', '-T', action='store_true',
+                        help="""Create a tar file (tgz by default; see --tar-codec) instead of zip""")
+    parser.add_argument('--tar-codec', choices=list(TAR_CODECS), default='gz',
+                        help="""Compression for tar files (--tar): gz (.tgz), bz2 (.tar.bz2), xz (.tar.xz)\n"""
+                        """or none (.tar).""")
+    parser.add_argument('--tar-level', type=int, choices=range(10), default=None, metavar='{0-9}',
+                        help="""Compression level for tar files (default: 9 for gz and bz2, 6 for xz).\n"""
+                        """Lower is faster; bz2 takes 1-9.""")
+    parser.add_argument('--name-only', action='store_true',
+                        help="""Don't build the archive; just return the name of the tar/zip file. (Requires hashing contents.)""")
+    parser.add_argument('--hash-only', action='store_true',
+                        help="""Don't build the archive; just return the hash of the given dir.""")
+    parser.add_argument('--validate', action='store_true',
+                        help="""Validate an unpacked archive (or a zip/tar artifact file, without unpacking it)\n"""
+                        """by checking its hash against the manifest.""")
+    parser.add_argument('--hash-scheme', choices=sorted(HASH_SCHEMES),
+                        default=LegacyContentHash.scheme,
+                        help="""Content hash scheme, recorded in the manifest. 'legacy' is one sequential SHA-1 over\n"""
+                        """the whole tree; 'tree-v1' hashes files separately (in parallel) and combines their digests.""")
+    parser.add_argument('--hash-algo', choices=HASH_ALGOS, default=DEFAULT_HASH_ALGO,
+                        help="""Digest algorithm for the content hash, recorded in the manifest. blake2b is\n"""
+                        """usually fastest on 64-bit machines; sha1 (the default) keeps existing artifact names.""")
+    parser.add_argument('--read-size', type=number_at_least(1), default=DEFAULT_READ_SIZE,
+                        help="""Bytes per read when hashing and archiving files.""")
+    parser.add_argument('--mmap-threshold', type=number_at_least(0), default=DEFAULT_MMAP_THRESHOLD,
+                        help="""Memory-map files at least this big when hashing them, instead of reading\n"""
+                        """them into a buffer. 0 means never.""")
+    parser.add_argument('--drop-page-cache', action='store_true',
+                        help="""Tell the OS to drop each file from the page cache once it's been hashed\n"""
+                        """(where posix_fadvise is available), so a huge tree doesn't evict the rest of the cache.""")
+    parser.add_argument('--jobs', '-j', type=number_at_least(1), default=os.cpu_count(),
+                        help="""Number of worker threads to use for tree-v1 hashing and zip compression.\n"""
+                        """The zip file is the same whatever the number of jobs.""")
+    parser.add_argument('--hash-cache',
+                        default=os.environ.get('BINARY_ARTIFACT_HASH_CACHE'),
+                        help="""File in which to cache per-file digests between runs (tree-v1 scheme only),\n"""
+                        """so unchanged files aren't re-read. Default: $BINARY_ARTIFACT_HASH_CACHE.""")
+    parser.add_argument('--no-hash-cache', action='store_true',
+                        help="""Don't use the hash cache even if one is configured.""")
+    parser.add_argument('--hash-cache-size', type=number_at_least(0), default=1000000,
+                        help="""Max number of entries to keep in the hash cache.""")
+    parser.add_argument('--compression', choices=['auto', 'deflate', 'store'], default='auto',
+                        help="""Zip compression policy: 'auto' stores already-compressed files (by extension,\n"""
+                        """or if a trial compression of their start doesn't shrink them) and deflates the rest.""")
+    parser.add_argument('--compresslevel', type=int, choices=range(-1, 10), default=zlib.Z_DEFAULT_COMPRESSION,
+                        metavar='{-1-9}',
+                        help="""Deflate compression level for zip files (-1 means zlib's default, 6).""")
+    parser.add_argument('--file-index', action='store_true',
+                        help="""Record each file's path, size and digest in the manifest, so --validate can\n"""
+                        """check files individually and report exactly which are missing, extra or changed.""")
+    parser.add_argument('--fail-fast', action='store_true',
+                        help="""With --validate and a file index, stop at the first mismatched file.""")
+    parser.add_argument('--full-hash', action='store_true',
+                        help="""With --validate, check the content hash even if there's a file index.""")
+    parser.add_argument('--exclude', action='append', default=[],
+                        help="""Exclude this file or dir name from the archive; may be a glob pattern like "*.o". May be repeated.""")
+    parser.add_argument('--include', action='append', default=[],
+                        help="""Include this filename in the archive as if it existed in the first source dir. May be repeated.""")
+    parser.add_argument('dir', nargs='*',
+                        help="""dirs to collect into the binary artifact (required unless --batch)""")
+    parser.add_argument('--batch', metavar='SPECFILE',
+                        help="""Build all the artifacts described in this JSON (or, with Python 3.11+, TOML) file,\n"""
+                        """each a set of options like {"name": "foo", "base-version": "1.0", "dir": ["bin"]},\n"""
+                        """and print a summary. Other command-line options apply to every artifact.""")
+    parser.add_argument('--batch-jobs', type=number_at_least(1), default=os.cpu_count(),
+                        help="""Number of artifacts to build at once in separate processes with --batch.""")
+    parser.add_argument('--top-dir-name', '-t',
+                        default=None,
+                        help="""Top dir of the resulting zip:\n"""
+                        """\tDefault=None means use the full name of the zip."""
+                        """\tA string means use that name as the top dir."""
+                        """\t'.' means no top dir; put the manifest and contents at top level.""")
+    parser.add_argument('--no-recurse',
+                        action='store_true',
+                        help="""Don't recurse into subdirs of the dirs passed on the command line; only include files directly in those dirs.""")
+    parser.add_argument('--include-hidden',
+                        action='store_true',
+                        help="""Include "hidden" files and dirs beginning with "." (e.g. .git).""")
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help="""Be more verbose about processing individual files and dirs.""")
+    return parser
 
-        if args.chdir is None:
-            dir = args.dir[0]
-        else:
-            dir = os.path.join(args.chdir, args.dir[0])
-
-        if args.build_branch is None:
-            args.build_branch = cmd("git rev-parse --abbrev-ref HEAD", 'build-branch', dir)
-            if args.build_branch is None:
-                logging.warning("Warning: Can't get default value for --build-branch; using None.")
-        if args.build_id is None:
-            args.build_id = cmd("git rev-parse --short=10 HEAD", 'build-id', dir)
-            if args.build_id is None:
-                logging.warning("Warning: Can't get default value for --build-id; using 1.")
-                args.build_id = 1
-
-        if args.validate:
-            validate_archive(args)
-        elif args.hash_only:
-            print_artifact_hash(args)
-        elif args.name_only:
-            print_artifact_name(args)
-        else:
-            create_artifact(args)
+def run_command(args, parser):
+    """Run what the parsed command line args ask for; returns the exit status."""
+    if args.tar_level is not None and args.tar_level not in TAR_CODECS[args.tar_codec][2]:
+        parser.error("--tar-level %d isn't valid for --tar-codec %s" % (args.tar_level, args.tar_codec))
+    if args.batch:
+        return run_batch(args, parser)
+    if args.store_cmd:
+        if not args.store:
+            parser.error("--store-cmd needs --store")
+        if args.store_cmd in ('rm', 'export') and not args.dir:
+            parser.error("--store-cmd %s needs the names of the artifacts" % args.store_cmd)
+        run_store_command(args)
         return 0
+    if args.serve:
+        HashServer(args).serve(args.serve)
+        return 0
+    if args.extract_member:
+        if not args.dir:
+            parser.error("--extract-member needs the artifact file")
+        extract_member(args)
+        return 0
+    if args.extract:
+        if not args.to:
+            parser.error("--extract needs --to")
+        extract_artifact(args)
+        return 0
+    required = (('dir', args.dir),)
+    if not args.apply_delta:
+        required += (('--base-version', args.base_version), ('--name', args.name))
+    missing = [option for option, value in required if not value]
+    if missing:
+        parser.error("the following arguments are required: %s" % ', '.join(missing))
+    if args.member_index and args.output:
+        parser.error("--member-index can't be used with --output")
+    if args.reuse_existing:
+        for option, value in (('--output', args.output), ('--member-index', args.member_index),
+                              ('--store', args.store), ('--delta-from', args.delta_from)):
+            if value:
+                parser.error("--reuse-existing can't be used with %s" % option)
+    # only building needs the machine and git metadata, so don't probe for it otherwise
+    prepare_args(args, metadata=not (args.apply_delta or args.validate or args.hash_only or args.name_only))
+    if args.apply_delta:
+        apply_delta(args)
+    elif args.validate:
+        validate_archive(args)
+    elif args.hash_only:
+        print_artifact_hash(args)
+    elif args.name_only:
+        fill_metadata(args, names_only=True)
+        print_artifact_name(args)
+    else:
+        create_artifact(args)
+    return 0
+
+def main(argv=None):
+    global stats
+    try:
+        parser = make_parser()
+        args = parser.parse_args(argv)
+        if args.stats or args.stats_json:
+            stats = PhaseStats(args.stats_top)
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(run_command, args, parser)
+            finally:
+                profiler.dump_stats(args.profile)
+                sys.stderr.write("Wrote profile to %s (view it with python -m pstats)\n" % args.profile)
+        return run_command(args, parser)
     except RuntimeError as e:
         print(e)
         return 1
+    finally:
+        if stats is not None:
+            stats.report(args.stats_json)
+            stats = None
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
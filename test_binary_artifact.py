@@ -21,8 +21,9 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import pytest
-import sys, os, os.path, subprocess
-import zipfile
+import sys, os, os.path, subprocess, io, socket, time
+import zipfile, tarfile
+import json, pstats
 
 @pytest.fixture
 def cd_tmp(tmpdir):
@@ -54,6 +55,16 @@ def get_artifact_name():
         return output.rstrip()
     return _get_artifact_name
 
+@pytest.fixture
+def get_artifact_hash():
+    topdir = os.getcwd()
+    def _get_artifact_hash(*args, **kwargs):
+        cmd_with_args=(sys.executable, os.path.join(topdir, 'build-binary-artifact.py'),
+                       '--hash-only', *args);
+        output = subprocess.check_output(cmd_with_args)
+        return output.rstrip()
+    return _get_artifact_hash
+
 @pytest.fixture
 def create_test_dir(tmpdir):
     srcdir = tmpdir.mkdir('src')
@@ -97,6 +108,17 @@ def test_chdir(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_t
         with zfile.open(name + '/file1.txt') as file1:
             assert(b'content' in file1.read())
 
+def test_file_arg(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    with open('top.txt', 'w') as f:
+        f.write('top content')
+    args = ('--name', 'foo', '-B', '1.0', 'src', 'top.txt')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        names = zfile.namelist()
+        assert(names.count(name + '/top.txt') == 1)
+        assert(zfile.read(name + '/top.txt') == b'top content')
+
 def test_note(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
     args = ('--name', 'foo', '-B', '1.0', 'src', '--note', 'hi there')
     name = get_artifact_name(*args).decode('utf-8')
@@ -111,6 +133,14 @@ def test_note(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tm
         with zfile.open(name + '/src/file1.txt') as file1:
             assert(b'content' in file1.read())
 
+def test_metadata_warnings(tmpdir, create_test_dir, cd_tmp):
+    # tmpdir isn't a git checkout, so only the fields not given are warned about
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    proc = subprocess.run((sys.executable, script, '--name', 'foo', '-B', '1.0', '-i', 'x', 'src'),
+                          stderr=subprocess.PIPE, check=True)
+    assert(b'--build-branch' in proc.stderr)
+    assert(b'--build-id' not in proc.stderr)
+
 def test_topdir(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
     args = ('--name', 'foo', '-B', '1.0', '--top-dir-name', 'xyz', 'src')
     name = get_artifact_name(*args).decode('utf-8')
@@ -181,5 +211,729 @@ def test_no_recurse(tmpdir, create_test_dir, create_artifact, get_artifact_name,
         with pytest.raises(KeyError):
             zfile.open(name + '/src/sub/subfile1.txt') # shouldn't exist
 
+def test_outdir_in_source(tmpdir, create_test_dir, create_artifact, get_artifact_name,
+                          get_artifact_hash, cd_tmp):
+    args = ('--name', 'foo', '-B', '1.0', '--outdir', 'src', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    hash = get_artifact_hash(*args).decode('utf-8')
+    assert(name.endswith('-' + hash))
+    create_artifact(*args)
+    # the archive is hashed as it's written, and isn't included in itself
+    assert(sorted(os.listdir(os.path.join(tmpdir, 'src'))) ==
+           ['.hidden.txt', 'file1.txt', 'file2.txt', name + '.zip', 'sub'])
+    with zipfile.ZipFile(os.path.join(tmpdir, 'src', name + '.zip')) as zfile:
+        assert(zfile.testzip() is None)
+        assert(sorted(zfile.namelist()) ==
+               [name + '/foo-manifest.txt', name + '/src/', name + '/src/file1.txt',
+                name + '/src/file2.txt', name + '/src/sub/subfile1.txt'])
+        with zfile.open(name + '/foo-manifest.txt') as manifest:
+            assert(('content-hash: %s' % hash).encode('utf-8') in manifest.read())
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+def test_validate(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, scheme):
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, '--chdir', 'src', '.')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        with zfile.open(name + '/foo-manifest.txt') as manifest:
+            assert(('hash-scheme: %s' % scheme).encode('utf-8') in manifest.read())
+        zfile.extractall('unpacked')
+    # --validate takes the scheme from the manifest, not the command line
+    validate = (sys.executable, os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py'),
+                '--validate', '--name', 'foo', '-B', '1.0', os.path.join('unpacked', name))
+    output = subprocess.check_output(validate)
+    assert(b'Hash OK' in output)
+    with open(os.path.join('unpacked', name, 'sub', 'subfile1.txt'), 'a') as f:
+        f.write('changed')
+    proc = subprocess.run(validate, stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Hash mismatch' in proc.stdout)
+
+def test_tree_hash_scheme(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    args = ('--name', 'foo', '-B', '1.0', 'src')
+    legacy_hash = get_artifact_hash(*args)
+    tree_hash = get_artifact_hash('--hash-scheme', 'tree-v1', *args)
+    assert(tree_hash != legacy_hash)
+    # the tree hash doesn't depend on how many workers computed it
+    assert(get_artifact_hash('--hash-scheme', 'tree-v1', '--jobs', '1', *args) == tree_hash)
+
+def test_hash_cache(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = (sys.executable, script, '--hash-only', '--name', 'foo', '-B', '1.0',
+            '--hash-scheme', 'tree-v1', '--hash-cache', 'cache.json', 'src')
+    first = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert(b'0 hits, 3 misses' in first.stderr)
+    second = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert(b'3 hits, 0 misses, 0 bytes read' in second.stderr)
+    assert(second.stdout == first.stdout)
+    with open(os.path.join('src', 'file2.txt'), 'a') as f:
+        f.write('more')
+    third = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert(b'2 hits, 1 misses, 18 bytes read' in third.stderr)
+    assert(third.stdout.rstrip() == get_artifact_hash('--name', 'foo', '-B', '1.0', '--no-hash-cache',
+                                                      '--hash-scheme', 'tree-v1', 'src'))
+    # a size of 0 keeps nothing
+    subprocess.run(args + ('--hash-cache-size', '0'), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    fourth = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert(b'0 hits, 3 misses' in fourth.stderr)
+
+def test_parallel_zip(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    # a file spanning several compression chunks
+    big = b''.join(b'line %d of a big compressible file\n' % i for i in range(200000))
+    with open(os.path.join('src', 'big.txt'), 'wb') as f:
+        f.write(big)
+    args = ('--name', 'foo', '-B', '1.0', '--date', 'today', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    contents = {}
+    for jobs in ('1', '4'):
+        os.mkdir('out' + jobs)
+        create_artifact('--jobs', jobs, '--outdir', 'out' + jobs, *args)
+        zip_path = os.path.join(tmpdir, 'out' + jobs, name + '.zip')
+        with zipfile.ZipFile(zip_path) as zfile:
+            assert(zfile.testzip() is None)
+            assert(zfile.read(name + '/src/big.txt') == big)
+            manifest_offset = zfile.getinfo(name + '/foo-manifest.txt').header_offset
+        with open(zip_path, 'rb') as f:
+            contents[jobs] = f.read(manifest_offset) # the manifest's timestamp can differ
+    assert(contents['1'] == contents['4'])
+
+@pytest.mark.parametrize('policy', ['auto', 'deflate', 'store'])
+def test_compression_policy(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, policy):
+    with open(os.path.join('src', 'image.png'), 'wb') as f:
+        f.write(b'not really a png ' * 1000)
+    with open(os.path.join('src', 'random.bin'), 'wb') as f:
+        f.write(os.urandom(20000))
+    with open(os.path.join('src', 'text.txt'), 'wb') as f:
+        f.write(b'very compressible text ' * 1000)
+    args = ('--name', 'foo', '-B', '1.0', '--compression', policy, '--compresslevel', '-1', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        assert(zfile.testzip() is None)
+        types = {os.path.basename(i.filename): i.compress_type for i in zfile.infolist()}
+    expected = {'auto': (zipfile.ZIP_STORED, zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED),
+                'deflate': (zipfile.ZIP_DEFLATED,) * 3,
+                'store': (zipfile.ZIP_STORED,) * 3}[policy]
+    assert((types['image.png'], types['random.bin'], types['text.txt']) == expected)
+
+@pytest.mark.parametrize('codec,ext', [('gz', '.tgz'), ('bz2', '.tar.bz2'), ('xz', '.tar.xz'), ('none', '.tar')])
+def test_tar(tmpdir, create_test_dir, create_artifact, get_artifact_name, get_artifact_hash,
+             cd_tmp, codec, ext):
+    args = ('--name', 'foo', '-B', '1.0', '--tar', '--tar-codec', codec, '--tar-level', '1',
+            '--exclude', 'file2.txt', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    hash = get_artifact_hash(*args).decode('utf-8')
+    create_artifact(*args)
+    tar_path = os.path.join(tmpdir, name + ext)
+    assert(os.path.exists(tar_path))
+    with tarfile.open(tar_path) as tfile:
+        # the same files as the hash: no excluded or hidden files
+        assert(sorted(tfile.getnames()) ==
+               [name + '/foo-manifest.txt', name + '/src', name + '/src/file1.txt',
+                name + '/src/sub/subfile1.txt'])
+        assert(tfile.extractfile(name + '/src/sub/subfile1.txt').read() == b'sub/subfile1 content')
+        manifest = tfile.extractfile(name + '/foo-manifest.txt').read()
+        assert(('content-hash: %s' % hash).encode('utf-8') in manifest)
+
+def test_tar_level_range(tmpdir, create_test_dir, create_artifact, cd_tmp):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = ('--name', 'foo', '-B', '1.0', '--tar', '--tar-level', '0', 'src')
+    proc = subprocess.run((sys.executable, script, '--tar-codec', 'bz2', *args), stderr=subprocess.PIPE)
+    assert(proc.returncode == 2)
+    assert(b"--tar-level 0 isn't valid for --tar-codec bz2" in proc.stderr)
+    assert(not [f for f in os.listdir('.') if f.startswith('foo-')])
+    create_artifact('--tar-codec', 'gz', *args)
+    assert([f for f in os.listdir('.') if f.endswith('.tgz')])
+
+def test_tar_topdir(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    args = ('--name', 'foo', '-B', '1.0', '--tar', '--top-dir-name', 'xyz', '--no-recurse', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with tarfile.open(os.path.join(tmpdir, name + '.tgz')) as tfile:
+        assert(sorted(tfile.getnames()) ==
+               ['xyz/foo-manifest.txt', 'xyz/src', 'xyz/src/file1.txt', 'xyz/src/file2.txt'])
+
+def test_tar_file_arg(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    with open('top.txt', 'w') as f:
+        f.write('top content')
+    args = ('--name', 'foo', '-B', '1.0', '--tar', 'src', 'top.txt')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with tarfile.open(os.path.join(tmpdir, name + '.tgz')) as tfile:
+        assert(sorted(tfile.getnames()) ==
+               [name + '/foo-manifest.txt', name + '/src', name + '/src/file1.txt',
+                name + '/src/file2.txt', name + '/src/sub/subfile1.txt', name + '/top.txt'])
+        assert(tfile.extractfile(name + '/top.txt').read() == b'top content')
+
+@pytest.mark.parametrize('tar', [False, True])
+def test_output_stdout(tmpdir, create_test_dir, get_artifact_name, cd_tmp, tar):
+    args = ('--name', 'foo', '-B', '1.0', 'src') + (('--tar',) if tar else ())
+    name = get_artifact_name(*args).decode('utf-8')
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    proc = subprocess.run((sys.executable, script, '--output', '-', '--manifest-out', 'manifest.txt') + args,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert(('Created binary artifact %s' % name).encode('utf-8') in proc.stderr)
+    assert(b'base-version: 1.0' in proc.stderr) # the manifest goes to stderr
+    with open('manifest.txt', 'rb') as f:
+        assert(('fullname: %s' % name).encode('utf-8') in f.read())
+    assert(not [f for f in os.listdir(str(tmpdir)) if f.startswith('foo-')]) # nothing written to outdir
+    if tar:
+        with tarfile.open(fileobj=io.BytesIO(proc.stdout)) as tfile:
+            assert(tfile.extractfile(name + '/src/file1.txt').read() == b'content')
+            assert(b'base-version: 1.0' in tfile.extractfile(name + '/foo-manifest.txt').read())
+    else:
+        with zipfile.ZipFile(io.BytesIO(proc.stdout)) as zfile:
+            assert(zfile.testzip() is None)
+            assert(zfile.read(name + '/src/sub/subfile1.txt') == b'sub/subfile1 content')
+            assert(b'base-version: 1.0' in zfile.read(name + '/foo-manifest.txt'))
+
+def test_validate_file_index(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    args = ('--name', 'foo', '-B', '1.0', '--file-index', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        manifest = zfile.read(name + '/foo-manifest.txt')
+        assert(b'file-count: 3\n' in manifest)
+        assert(b' 7 src/file1.txt\n' in manifest)
+        zfile.extractall('unpacked')
+    unpacked = os.path.join('unpacked', name)
+    validate = (sys.executable, os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py'),
+                '--validate', '--name', 'foo', '-B', '1.0', unpacked)
+    assert(b'Files OK: 3 files' in subprocess.check_output(validate))
+    with open(os.path.join(unpacked, 'src', 'file1.txt'), 'w') as f:
+        f.write('CONTENT')      # same size
+    os.unlink(os.path.join(unpacked, 'src', 'file2.txt'))
+    with open(os.path.join(unpacked, 'src', 'new.txt'), 'w') as f:
+        f.write('new')
+    proc = subprocess.run(validate, stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Changed: src/file1.txt\nMissing: src/file2.txt\nExtra: src/new.txt\n' in proc.stdout)
+    assert(b'1 missing, 1 extra, 1 changed' in proc.stdout)
+    proc = subprocess.run(validate + ('--fail-fast',), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(proc.stdout.count(b': src/') == 1)
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+def test_validate_packed(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, scheme, kind):
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, '--chdir', 'src', '.')
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    packed = os.path.join(tmpdir, name + '.' + kind)
+    validate = (sys.executable, os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py'),
+                '--validate', '--name', 'foo', '-B', '1.0')
+    assert(b'Hash OK' in subprocess.check_output(validate + (packed,)))
+    # repack with one file changed, without unpacking to disk
+    tampered = os.path.join(tmpdir, 'tampered.' + kind)
+    changed = name + '/sub/subfile1.txt'
+    if kind == 'zip':
+        with zipfile.ZipFile(packed) as src, zipfile.ZipFile(tampered, 'w') as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                dst.writestr(info, data + b'x' if os.path.normpath(info.filename) == changed else data)
+    else:
+        with tarfile.open(packed) as src, tarfile.open(tampered, 'w:gz') as dst:
+            for member in src.getmembers():
+                data = src.extractfile(member).read() if member.isfile() else None
+                if os.path.normpath(member.name) == changed:
+                    data += b'x'
+                    member.size = len(data)
+                dst.addfile(member, io.BytesIO(data) if data is not None else None)
+    proc = subprocess.run(validate + (tampered,), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Hash mismatch' in proc.stdout)
+    # with a file index, the bad file is named
+    args = ('--file-index',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    output = subprocess.check_output(validate + (os.path.join(tmpdir, name + '.' + kind),))
+    assert(b'Files OK: 3 files' in output)
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+@pytest.mark.parametrize('dirs', [('src',), ('src', 'lib')])
+def test_validate_default_layout(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp,
+                                 scheme, kind, dirs):
+    # dirs named on the command line are archived under their own names but
+    # hashed relative to themselves; validation has to see them the same way
+    tmpdir.mkdir('lib').join('lib1.txt').write('lib content')
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme) + dirs
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    packed = os.path.join(tmpdir, name + '.' + kind)
+    validate = (sys.executable, os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py'),
+                '--validate', '--name', 'foo', '-B', '1.0')
+    assert(b'Hash OK' in subprocess.check_output(validate + (packed,)))
+    if kind == 'zip':
+        with zipfile.ZipFile(packed) as zfile:
+            zfile.extractall('unpacked[1]')
+    else:
+        with tarfile.open(packed) as tfile:
+            tfile.extractall('unpacked[1]')
+    unpacked = os.path.join('unpacked[1]', name) # glob chars in the path are taken literally
+    assert(b'Hash OK' in subprocess.check_output(validate + (unpacked,)))
+    with open(os.path.join(unpacked, 'src', 'file1.txt'), 'a') as f:
+        f.write('x')
+    proc = subprocess.run(validate + (unpacked,), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Hash mismatch' in proc.stdout)
+
+def test_exclude_glob(tmpdir, create_test_dir, create_artifact, get_artifact_name, get_artifact_hash, cd_tmp):
+    args = ('--name', 'foo', '-B', '1.0', '--exclude', '*2.txt', '--exclude', 's?b', 'src')
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        assert(sorted(zfile.namelist()) ==
+               [name + '/foo-manifest.txt', name + '/src/', name + '/src/file1.txt'])
+    # a glob excludes the same files as the equivalent plain names
+    assert(get_artifact_hash(*args) ==
+           get_artifact_hash('--name', 'foo', '-B', '1.0', '--exclude', 'file2.txt', '--exclude', 'sub', 'src'))
+
+@pytest.mark.parametrize('option', [('--read-size', '0'), ('--mmap-threshold', '-1'), ('--jobs', '0'),
+                                    ('--gzip-block-size', '0'), ('--gzip-block-size', '-5'),
+                                    ('--hash-cache-size', '-1')])
+def test_bad_sizes(tmpdir, create_test_dir, cd_tmp, option):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    proc = subprocess.run((sys.executable, script, '--hash-only', *option, 'src'), stderr=subprocess.PIPE)
+    assert(proc.returncode == 2)
+    assert(('argument %s' % option[0]).encode('utf-8') in proc.stderr)
+    assert(b'must be at least' in proc.stderr)
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+def test_hash_algo(tmpdir, create_test_dir, create_artifact, get_artifact_name, get_artifact_hash,
+                   cd_tmp, scheme):
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, '--chdir', 'src', '.')
+    sha1_hash = get_artifact_hash(*args)
+    assert(get_artifact_hash('--hash-algo', 'sha1', '--read-size', '3', *args) == sha1_hash)
+    args = ('--hash-algo', 'blake2b') + args
+    assert(get_artifact_hash(*args) != sha1_hash)
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    create_artifact('--tar', *args)
+    with zipfile.ZipFile(os.path.join(tmpdir, name + '.zip')) as zfile:
+        assert(b'hash-algo: blake2b\n' in zfile.read(name + '/foo-manifest.txt'))
+        zfile.extractall('unpacked')
+    # --validate takes the algo from the manifest, unpacked or not
+    validate = (sys.executable, os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py'),
+                '--validate', '--name', 'foo', '-B', '1.0')
+    for path in (os.path.join('unpacked', name), name + '.zip', name + '.tgz'):
+        assert(b'Hash OK' in subprocess.check_output(validate + (os.path.join(tmpdir, path),)))
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+def test_mmap_hashing(tmpdir, create_test_dir, get_artifact_hash, cd_tmp, scheme):
+    tmpdir.join('src/big.bin').write_binary(os.urandom(100000))
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, 'src')
+    hash = get_artifact_hash('--mmap-threshold', '0', *args)
+    # mapped or read into a buffer, in any size pieces, the hash is the same
+    assert(get_artifact_hash('--mmap-threshold', '1', *args) == hash)
+    assert(get_artifact_hash('--mmap-threshold', '1', '--read-size', '7', *args) == hash)
+    assert(get_artifact_hash('--read-size', '7', '--drop-page-cache', *args) == hash)
+
+def test_builder_api(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    import binary_artifact
+    builder = binary_artifact.ArtifactBuilder(outdir='out', silent=True)
+    os.mkdir('out')
+    results = builder.build_all([{'dir': ['src'], 'name': 'foo', 'base_version': '1.0'},
+                                 {'dir': '.', 'name': 'bar', 'base_version': '2.0', 'chdir': 'src',
+                                  'tar': True}])
+    assert(os.getcwd() == str(tmpdir))      # restored after chdir
+    assert([os.path.dirname(r.path) for r in results] == [os.path.join(str(tmpdir), 'out')] * 2)
+    assert(results[0].hash == get_artifact_hash('--name', 'foo', '-B', '1.0', 'src').decode('utf-8'))
+    assert(results[1].path == os.path.join(str(tmpdir), 'out', results[1].name + '.tgz'))
+    # metadata is computed once and shared
+    with zipfile.ZipFile(results[0].path) as zfile:
+        foo = zfile.read(results[0].name + '/foo-manifest.txt').decode('utf-8')
+    with tarfile.open(results[1].path) as tfile:
+        bar = tfile.extractfile(results[1].name + '/bar-manifest.txt').read().decode('utf-8')
+    date = [line for line in foo.splitlines() if line.startswith('build-date: ')]
+    assert(date and date[0] in bar)
+    with pytest.raises(TypeError):
+        builder.build('src', 'foo', '1.0', no_such_option=True)
+
+def test_batch(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    import json
+    os.mkdir('out')
+    with open('specs.json', 'w') as f:
+        json.dump({'defaults': {'base-version': '1.0', 'hash-scheme': 'tree-v1'},
+                   'artifacts': [{'name': 'foo', 'dir': 'src'},
+                                 {'name': 'bar', 'dir': ['src'], 'tar': True, 'exclude': '*2.txt'},
+                                 {'name': 'baz', 'dir': 'missing'}]}, f)
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    proc = subprocess.run((sys.executable, script, '--batch', 'specs.json', '--outdir', 'out',
+                           '--batch-jobs', '2'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert(proc.returncode == 1)        # baz failed, the others were built
+    lines = proc.stdout.decode('utf-8').splitlines()
+    assert('Failed to build baz' in lines[0])
+    assert(lines[1].split() == ['artifact', 'seconds', 'bytes', 'read', 'size'])
+    foo_hash = get_artifact_hash('--name', 'foo', '-B', '1.0', '--hash-scheme', 'tree-v1', 'src')
+    foo = lines[2].split()
+    assert(foo[0].endswith(foo_hash.decode('utf-8') + '.zip'))
+    assert(foo[2] == '41')              # bytes of src files read
+    assert(int(foo[3]) == os.path.getsize(os.path.join('out', foo[0])))
+    assert(lines[3].split()[0].endswith('.tgz'))
+    assert(os.path.exists(os.path.join('out', lines[3].split()[0])))
+    assert(lines[4].split()[:2] == ['baz', 'FAILED'])
+    assert(lines[5].startswith('total'))
+
+@pytest.mark.parametrize('kind', ['zip', 'tgz', 'tar'])
+def test_reuse_existing(tmpdir, create_test_dir, get_artifact_name, cd_tmp, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = ('--name', 'foo', '-B', '1.0', '--file-index', 'src')
+    if kind != 'zip':
+        args = ('--tar', '--tar-codec', 'gz' if kind == 'tgz' else 'none') + args
+    build = (sys.executable, script, '--reuse-existing') + args
+    first = subprocess.run(build + ('-i', 'aaa'), stderr=subprocess.PIPE, check=True)
+    assert(b'Reused' not in first.stderr)
+    second = subprocess.run(build + ('-i', 'bbb'), stderr=subprocess.PIPE, check=True)
+    assert(b'Reused existing artifact' in second.stderr)
+    name = get_artifact_name('-i', 'bbb', *args).decode('utf-8')
+    path = os.path.join(tmpdir, name + '.' + kind)
+    validate = (sys.executable, script, '--validate', '--name', 'foo', '-B', '1.0', path)
+    assert(b'Files OK: 3 files' in subprocess.check_output(validate))
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as zfile:
+            assert(zfile.testzip() is None)
+            manifest = zfile.read(name + '/foo-manifest.txt')
+            assert(zfile.read(name + '/src/sub/subfile1.txt') == b'sub/subfile1 content')
+    else:
+        with tarfile.open(path) as tfile:
+            manifest = tfile.extractfile(name + '/foo-manifest.txt').read()
+            assert(tfile.extractfile(name + '/src/sub/subfile1.txt').read() == b'sub/subfile1 content')
+    assert(b'build-id: bbb\n' in manifest)
+    assert(manifest.count(b'file: ') == 3)
+    # a different length top-level dir can't be patched in place (except by recompressing)
+    third = subprocess.run(build + ('-i', 'cccc'), stderr=subprocess.PIPE, check=True)
+    assert((b'Reused existing artifact' in third.stderr) == (kind == 'tgz'))
+    name = get_artifact_name('-i', 'cccc', *args).decode('utf-8')
+    validate = validate[:-1] + (os.path.join(tmpdir, name + '.' + kind),)
+    assert(b'Files OK: 3 files' in subprocess.check_output(validate))
+    # options it can't honor are refused, not ignored
+    proc = subprocess.run(build + ('--member-index',), stderr=subprocess.PIPE)
+    assert(proc.returncode == 2)
+    assert(b"--reuse-existing can't be used with --member-index" in proc.stderr)
+
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+def test_delta(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    ext = '.tgz' if kind == 'tgz' else '.zip'
+    args = ('--name', 'foo', '-B', '1.0', '--chdir', 'src', '.')
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    # a manifest shipped in the tree mustn't be taken for the base's
+    with open(os.path.join('src', 'sub', 'vendor-manifest.txt'), 'w') as f:
+        f.write('content-hash: 0000000000000000\nfile-count: 1\n')
+    base = get_artifact_name('-i', 'aaa', *args).decode('utf-8')
+    create_artifact('-i', 'aaa', *args)
+    with open(os.path.join('src', 'file1.txt'), 'a') as f:
+        f.write('changed')
+    os.unlink(os.path.join('src', 'file2.txt'))
+    with open(os.path.join('src', 'new.txt'), 'w') as f:
+        f.write('new')
+    name = get_artifact_name('-i', 'bbb', *args).decode('utf-8')
+    create_artifact('-i', 'bbb', '--delta-from', base + ext, *args)
+    delta = name + '-delta' + ext
+    if kind == 'tgz':
+        with tarfile.open(delta) as tf:
+            files = sorted(os.path.normpath(m.name) for m in tf.getmembers() if m.isfile())
+            manifest = tf.extractfile(name + '/foo-manifest.txt').read()
+    else:
+        with zipfile.ZipFile(delta) as zf:
+            files = sorted(os.path.normpath(n) for n in zf.namelist() if not n.endswith('/'))
+            manifest = zf.read(name + '/foo-manifest.txt')
+    # (files outside the content hash, like manifests, always go in a delta)
+    assert(files == sorted(os.path.join(name, f) for f in ('file1.txt', 'new.txt', 'foo-manifest.txt',
+                                                           os.path.join('sub', 'vendor-manifest.txt'))))
+    assert(b'removed: file2.txt\n' in manifest)
+    assert(b'delta-from: ' + base.encode('utf-8') in manifest)
+    # a delta isn't valid on its own
+    proc = subprocess.run((sys.executable, script, '--validate', '--name', 'foo', '-B', '1.0', delta),
+                          stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    # applied to the unpacked base, it makes the full tree
+    if kind == 'tgz':
+        with tarfile.open(base + ext) as tf:
+            tf.extractall('unpacked')
+    else:
+        with zipfile.ZipFile(base + ext) as zf:
+            zf.extractall('unpacked')
+    unpacked = os.path.join('unpacked', base)
+    output = subprocess.check_output((sys.executable, script, '--apply-delta', delta, unpacked))
+    assert(b'Hash OK: ' + name[-16:].encode('utf-8') in output)
+    assert(not os.path.exists(os.path.join(unpacked, 'file2.txt')))
+    with open(os.path.join(unpacked, 'new.txt')) as f:
+        assert(f.read() == 'new')
+    # but not to anything else
+    proc = subprocess.run((sys.executable, script, '--apply-delta', delta, unpacked), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Delta base mismatch' in proc.stdout)
+
+def test_delta_default_layout(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = ('--name', 'foo', '-B', '1.0', 'src')
+    base = get_artifact_name('-i', 'aaa', '--file-index', *args).decode('utf-8')
+    create_artifact('-i', 'aaa', '--file-index', *args)
+    with open(os.path.join('src', 'file1.txt'), 'a') as f:
+        f.write('changed')
+    os.unlink(os.path.join('src', 'sub', 'subfile1.txt'))
+    name = get_artifact_name('-i', 'bbb', *args).decode('utf-8')
+    create_artifact('-i', 'bbb', '--delta-from', base + '.zip', *args)
+    delta = name + '-delta.zip'
+    for unpacked in ('good', 'bad'):
+        with zipfile.ZipFile(base + '.zip') as zf:
+            zf.extractall(unpacked)
+    output = subprocess.check_output((sys.executable, script, '--apply-delta', delta, os.path.join('good', base)))
+    assert(b'Hash OK: ' + name[-16:].encode('utf-8') in output)
+    assert(not os.path.exists(os.path.join('good', base, 'src', 'sub')))
+    # a base that was changed after unpacking fails the final check, and says it's been changed
+    with open(os.path.join('bad', base, 'src', 'file2.txt'), 'a') as f:
+        f.write('changed')
+    proc = subprocess.run((sys.executable, script, '--apply-delta', delta, os.path.join('bad', base)),
+                          stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Hash mismatch' in proc.stdout)
+    assert(b'The delta has been applied' in proc.stdout)
+
+def test_store(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    def store_cmd(*args):
+        return subprocess.check_output((sys.executable, script, '--store', 'store', '--store-cmd') + args)
+    with open(os.path.join('src', 'pic.png'), 'wb') as f:
+        f.write(b'\0' * 10000)
+    args = ('--name', 'foo', '-B', '1.0', '--store', 'store', '--chdir', 'src', '.')
+    first = get_artifact_name('-i', 'aaa', *args).decode('utf-8')
+    create_artifact('-i', 'aaa', *args)
+    with open(os.path.join('src', 'file1.txt'), 'a') as f:
+        f.write('changed')
+    second = get_artifact_name('-i', 'bbb', *args).decode('utf-8')
+    create_artifact('-i', 'bbb', *args)
+    assert(sorted(os.listdir(os.path.join('store', 'artifacts'))) == [first + '.json', second + '.json'])
+    # 4 files each, but only file1.txt differs
+    assert(sum(len(files) for _, _, files in os.walk(os.path.join('store', 'blobs'))) == 5)
+    listing = store_cmd('ls')
+    assert(first.encode('utf-8') in listing and second.encode('utf-8') in listing)
+    assert(b'Blobs: 5' in store_cmd('du'))
+    store_cmd('export', '--outdir', 'out', first)
+    with zipfile.ZipFile(os.path.join('out', first + '.zip')) as zfile:
+        assert(sorted(zfile.namelist()) ==
+               [first + '/file1.txt', first + '/file2.txt', first + '/foo-manifest.txt',
+                first + '/pic.png', first + '/sub/subfile1.txt'])
+        # --compression auto goes by the file's name, not the blob's
+        assert(zfile.getinfo(first + '/pic.png').compress_type == zipfile.ZIP_STORED)
+    output = subprocess.check_output((sys.executable, script, '--validate', '--name', 'foo', '-B', '1.0',
+                                      os.path.join('out', first + '.zip')))
+    assert(b'Hash OK' in output)
+    assert(b'Deleted 1 unreferenced blobs' in store_cmd('rm', first))
+    assert(os.listdir(os.path.join('store', 'artifacts')) == [second + '.json'])
+    assert(b'Deleted 0 unreferenced blobs' in store_cmd('gc'))
+
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+def test_extract(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = ('--name', 'foo', '-B', '1.0', '--chdir', 'src', '.')
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    artifact = name + ('.tgz' if kind == 'tgz' else '.zip')
+    extract = (sys.executable, script, '--extract', artifact, '--to', 'out', '--jobs', '2')
+    assert(b'Hash OK' in subprocess.check_output(extract))
+    with open(os.path.join('out', 'sub', 'subfile1.txt')) as f:
+        assert(f.read() == 'sub/subfile1 content')
+    assert(b'Hash OK' in subprocess.check_output((sys.executable, script, '--validate', '--name', 'foo',
+                                                  '-B', '1.0', 'out')))
+    # a tampered artifact is never unpacked
+    if kind == 'tgz':
+        with tarfile.open(artifact) as tin, tarfile.open('bad.tgz', 'w:gz') as tout:
+            for member in tin.getmembers():
+                data = tin.extractfile(member).read() if member.isfile() else None
+                if member.name.endswith('file1.txt'):
+                    data = data.upper()
+                tout.addfile(member, io.BytesIO(data) if data is not None else None)
+    else:
+        with zipfile.ZipFile(artifact) as zin, zipfile.ZipFile('bad.zip', 'w') as zout:
+            for info in zin.infolist():
+                data = zin.read(info)
+                zout.writestr(info, data.upper() if info.filename.endswith('file1.txt') else data)
+    proc = subprocess.run((sys.executable, script, '--extract', 'bad.' + kind, '--to', 'bad'), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Hash mismatch' in proc.stdout)
+    assert(not os.path.exists('bad'))
+    assert(not [f for f in os.listdir('.') if f.endswith('.tmp')])
+
+@pytest.mark.parametrize('scheme', ['legacy', 'tree-v1'])
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+def test_extract_default_layout(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, scheme, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    tmpdir.mkdir('lib').join('lib1.txt').write('lib content')
+    args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, 'src', 'lib')
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    artifact = name + ('.tgz' if kind == 'tgz' else '.zip')
+    extract = (sys.executable, script, '--extract', artifact, '--to', 'out', '--jobs', '2')
+    assert(b'Hash OK' in subprocess.check_output(extract))
+    with open(os.path.join('out', 'src', 'sub', 'subfile1.txt')) as f:
+        assert(f.read() == 'sub/subfile1 content')
+    with open(os.path.join('out', 'lib', 'lib1.txt')) as f:
+        assert(f.read() == 'lib content')
+
+def test_bench(tmpdir, cd_tmp):
+    bench = os.path.join(os.path.dirname(__file__), 'bench_binary_artifact.py')
+    run = (sys.executable, bench, '--scale', '0.001', '--repeat', '1', '--trees', 'tiny', 'deep',
+           '--startup-runs', '1')
+    output = subprocess.check_output(run + ('--json', 'bench.json'))
+    assert(b'tiny/zip' in output)
+    with open('bench.json') as f:
+        results = json.load(f)['results']
+    assert(sorted(results) == sorted(['%s/%s' % (tree, op) for tree in ('deep', 'tiny')
+                                      for op in ('hash', 'zip', 'tar', 'validate')] +
+                                     ['startup/python', 'startup/script', 'startup/module']))
+    assert(all(result['mb_per_s'] > 0 for key, result in results.items() if not key.startswith('startup/')))
+    proc = subprocess.run(run + ('--compare', 'bench.json', '--threshold', '1000'), stdout=subprocess.PIPE)
+    assert(proc.returncode == 0)
+    assert(b'REGRESSION' not in proc.stdout)
+
+def test_stats_and_profile(tmpdir, create_test_dir, create_artifact, cd_tmp):
+    create_artifact('--name', 'foo', '-B', '1.0', '--stats-json', 'stats.json', '--stats-top', '2',
+                    '--profile', 'profile.out', 'src')
+    with open('stats.json') as f:
+        stats = json.load(f)
+    assert({'walk', 'archive', 'manifest'} <= set(stats['phases']))
+    assert(stats['files'] == 3)
+    assert(stats['bytes_written'] > 0)
+    assert(len(stats['slowest_files']) == 2)
+    assert(pstats.Stats('profile.out').total_calls > 0)
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    proc = subprocess.run((sys.executable, script, '--name', 'foo', '-B', '1.0', '--hash-only', '--stats', 'src'),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert(b'Slowest files:' in proc.stderr)
+    assert(b'phase' not in proc.stdout)
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="needs Unix domain sockets")
+def test_serve(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    server = subprocess.Popen((sys.executable, script, '--serve', 'hash.sock', '--poll-interval', '0.2',
+                               '--idle-expiry', '1'), stdout=subprocess.PIPE)
+    try:
+        for i in range(100):
+            if os.path.exists('hash.sock'):
+                break
+            time.sleep(0.05)
+        for scheme in ('legacy', 'tree-v1'):
+            args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', scheme, 'src')
+            assert(get_artifact_hash('--server', 'hash.sock', *args) == get_artifact_hash(*args))
+        with open(os.path.join('src', 'file1.txt'), 'a') as f:
+            f.write('changed')
+        # answered right away, even before the next poll
+        args = ('--name', 'foo', '-B', '1.0', '--hash-scheme', 'tree-v1', 'src')
+        new_hash = get_artifact_hash(*args)
+        assert(get_artifact_hash('--server', 'hash.sock', *args) == new_hash)
+        # a client that never sends its query doesn't hold up the next one
+        query = {'op': 'hash', 'cwd': os.getcwd(), 'dir': ['src'], 'include': [], 'exclude': [],
+                 'include_hidden': False, 'no_recurse': False, 'hash_scheme': 'tree-v1', 'hash_algo': 'sha1'}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle, \
+             socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            idle.connect('hash.sock')
+            sock.connect('hash.sock')
+            sock.settimeout(10)
+            sock.sendall(json.dumps(query).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                assert(json.loads(f.readline()) == {'hash': new_hash.decode('utf-8')})
+        time.sleep(1.5)     # long enough for the trees to be forgotten
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect('hash.sock')
+            sock.sendall(b'{"op": "stop"}\n')
+            sock.recv(16)
+        output = server.communicate(timeout=10)[0]
+    finally:
+        if server.poll() is None:
+            server.kill()
+    assert(output.count(b'Hashed src in ') >= 2)
+    assert(b'src in %s: %s' % (os.getcwd().encode('utf-8'), new_hash) in output)
+    assert(b'Forgetting src in %s: idle' % os.getcwd().encode('utf-8') in output)
+    assert(b'uses the legacy scheme' in output)
+    assert(not os.path.exists('hash.sock'))
+    # with no server, the client hashes the files itself
+    assert(get_artifact_hash('--server', 'hash.sock', *args) == get_artifact_hash(*args))
+
+def test_lazy_startup(tmpdir, create_test_dir, get_artifact_hash, cd_tmp):
+    # --hash-only doesn't import the archive or metadata modules (or run git)
+    code = ("import sys; sys.path.insert(0, %r); import binary_artifact; "
+            "binary_artifact.main(['--name', 'foo', '-B', '1.0', '--hash-only', 'src']); "
+            "print(sorted(m for m in ('tarfile', 'zipfile', 'subprocess', 'socket', 'platform', 'getpass', "
+            "'tempfile', 'concurrent.futures') if m in sys.modules))") % os.path.dirname(__file__)
+    output = subprocess.check_output((sys.executable, '-c', code)).split(b'\n')
+    assert(output[0] == get_artifact_hash('--name', 'foo', '-B', '1.0', 'src'))
+    assert(output[1] == b'[]')
+    # and binary_artifact.py runs as the command too
+    output = subprocess.check_output((sys.executable, os.path.join(os.path.dirname(__file__), 'binary_artifact.py'),
+                                      '--name', 'foo', '-B', '1.0', '--hash-only', 'src'))
+    assert(output.rstrip() == get_artifact_hash('--name', 'foo', '-B', '1.0', 'src'))
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tgz', 'tar'])
+def test_member_index(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    big = bytes(range(256)) * 40
+    with open(os.path.join('src', 'sub', 'big.bin'), 'wb') as f:
+        f.write(big)
+    args = ('--name', 'foo', '-B', '1.0', '--chdir', 'src', '.')
+    if kind != 'zip':
+        args = ('--tar', '--tar-codec', 'gz' if kind == 'tgz' else 'none') + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact('--member-index', '--gzip-block-size', '1024', *args)
+    artifact = name + {'zip': '.zip', 'tgz': '.tgz', 'tar': '.tar'}[kind]
+    with open(artifact + '.idx') as f:
+        index = json.load(f)
+    assert(index['members']['sub/big.bin'][2] == len(big))
+    if kind == 'tgz':
+        assert(len(index['blocks']) > 5)
+        with tarfile.open(artifact) as tf:  # still an ordinary gzipped tar
+            member = [m for m in tf.getmembers() if m.name.endswith('/sub/big.bin')][0]
+            assert(tf.extractfile(member).read() == big)
+    extract = (sys.executable, script, '--extract-member')
+    assert(subprocess.check_output(extract + ('sub/big.bin', artifact)) == big)
+    assert(subprocess.check_output(extract + ('file1.txt', artifact)) == b'content')
+    assert(b'digest OK' in subprocess.check_output(extract + ('sub/subfile1.txt', artifact, '--to', 'out')))
+    with open(os.path.join('out', 'sub', 'subfile1.txt')) as f:
+        assert(f.read() == 'sub/subfile1 content')
+    # a member that doesn't match its digest is never written
+    index['members']['sub/big.bin'][3] = '0' * len(index['members']['sub/big.bin'][3])
+    with open(artifact + '.idx', 'w') as f:
+        json.dump(index, f)
+    proc = subprocess.run(extract + ('sub/big.bin', artifact, '--to', 'bad'), stderr=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'Digest mismatch for sub/big.bin' in proc.stderr)
+    assert(not os.path.exists(os.path.join('bad', 'sub', 'big.bin')))
+    # without the index, the archive is scanned instead
+    os.unlink(artifact + '.idx')
+    assert(subprocess.check_output(extract + ('sub/big.bin', artifact)) == big)
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tgz'])
+def test_extract_member_scan(tmpdir, create_test_dir, create_artifact, get_artifact_name, cd_tmp, kind):
+    script = os.path.join(os.path.dirname(__file__), 'build-binary-artifact.py')
+    args = ('--name', 'foo', '-B', '1.0', '--file-index', '--top-dir-name', '', 'src')
+    if kind == 'tgz':
+        args = ('--tar',) + args
+    name = get_artifact_name(*args).decode('utf-8')
+    create_artifact(*args)
+    artifact = name + '.' + kind
+    extract = (sys.executable, script, '--extract-member')
+    # no index: the member is checked against the manifest's file index
+    output = subprocess.check_output(extract + ('src/sub/subfile1.txt', artifact, '--to', 'out'))
+    assert(b'digest OK' in output)
+    with open(os.path.join('out', 'src', 'sub', 'subfile1.txt')) as f:
+        assert(f.read() == 'sub/subfile1 content')
+    # with no top-level dir, src/ is part of the path
+    proc = subprocess.run(extract + ('file1.txt', artifact), stdout=subprocess.PIPE)
+    assert(proc.returncode == 1)
+    assert(b'No member file1.txt' in proc.stdout)
+
 
 # end of file